@@ -1,7 +1,23 @@
+import argparse
+import bisect
+import codecs
+import collections
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import mmap
 import os
 import re
+import shutil
 import sys
-from typing import NamedTuple
+import time
+from array import array
+from concurrent import futures  # whose executors are only imported when first used
+from itertools import chain, count, islice, repeat
+from operator import attrgetter
+from typing import NamedTuple, Optional
 import logging
 
 # TODO: refactor, one thing, see if _eat can be called before handling the lexical
@@ -9,8 +25,24 @@ import logging
 
 IN_FILE_EXT = '.jack'
 OUT_FILE_EXT = '_test.xml'
+BINARY_OUT_FILE_EXT = '_test.jkb'
+TOKEN_OUT_FILE_EXTS = {'xml': 'T_test.xml', 'jsonl': 'T_test.jsonl'}  # by token output format
+COMPRESSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}  # extension appended to the outputs compressed with each
 NEWLINE = '\n'
 INDENT_NUM_SPACES = 2
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'SyntaxAnalyzer')
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+CACHE_EVICT_INTERVAL_SECONDS = 10 * 60
+READ_CHUNK_SIZE = 1 << 16
+TOKEN_BATCH_SIZE = 4096
+EMITTER_FLUSH_LINES = 4096
+WATCH_INTERVAL_SECONDS = 0.2
+ASYNC_QUEUE_DEPTH = 8
+ASYNC_IO_WORKERS = 4
+BATCH_CHUNK_SIZE = 16
+DISCOVERY_CHUNK_SIZE = 4
+WATCH_DEBOUNCE_SECONDS = 0.05
 # Jack Lexical elements
 # keywords
 CLASS = 'class'
@@ -58,23 +90,152 @@ TILDE = '~'
 DOUBLE_QUOTES = '"'
 INT_CONSTANT = 'integerConstant'
 STR_CONSTANT = 'stringConstant'
+OPEN_COMMENT = 'openComment'
 IDENTIFIER = 'identifier'
 KEYWORD = 'keyword'
 SYMBOL = 'symbol'
 
+# token types in the order of their codes in a TokenBuffer
+TOKEN_TYPES = (KEYWORD, SYMBOL, INT_CONSTANT, STR_CONSTANT, IDENTIFIER)
+TOKEN_TYPE_CODES = {token_type: code for code, token_type in enumerate(TOKEN_TYPES)}
+INT_CONSTANT_CODE = TOKEN_TYPE_CODES[INT_CONSTANT]
+
 UNARY_OP = {MINUS, TILDE}   # faster for in operator
 OP = {PLUS, MINUS, ASTERISK, FORWARD_SLASH, AMPERSAND, PIPE, LESS_THAN, GREATER_THAN, EQUAL_SIGN}
 KEYWORD_CONSTANT = {TRUE, FALSE, NULL, THIS}
+STATEMENT_KEYWORDS = {LET, IF, WHILE, DO, RETURN}
+CLASS_MEMBER_KEYWORDS = {STATIC, FIELD, CONSTRUCTOR, FUNCTION, METHOD}
+
+# productions of CompilationEngine._compile_expression_tree, and what it can be left to do after a nested one
+EXPRESSION, TERM, EXPRESSION_LIST = 0, 1, 2
+_MORE_TERMS, _MORE_EXPRESSIONS, _CLOSE_TERM, _CLOSE_PAREN, _CLOSE_BRACKET = 3, 4, 5, 6, 7
 
 
 class ParseException(Exception):
     pass
 
 
+class Diagnostic(NamedTuple):
+    line_number: int
+    message: str
+    column: int = 0  # 0 if not known
+
+    def __str__(self):
+        if self.column:
+            return f'line {self.line_number}, column {self.column}: {self.message}'
+        return f'line {self.line_number}: {self.message}'
+
+
+class ParseErrors(ParseException):
+    """every error found in a jack source file by the error recovering mode"""
+
+    def __init__(self, diagnostics):
+        """
+        Args:
+            diagnostics (list): Diagnostic of each error, in source order
+        """
+        super().__init__(f'{len(diagnostics)} syntax error{"s" if len(diagnostics) > 1 else ""}')
+        self.diagnostics = diagnostics
+
+
 class Token(NamedTuple):
     type: str
     value: str
     line_number: int
+    column: int = 0  # 0 if not known
+
+
+class TokenBuffer:
+    """tokens of a jack source stored column wise in arrays instead of as one Token object each
+    token values are only sliced from the source when asked for
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.type_codes = array('B')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.line_numbers = array('q')
+        self.columns = array('q')
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def __getitem__(self, i):
+        return Token(self.type(i), self.value(i), self.line_numbers[i], self.columns[i])
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+    def append(self, token_type, start, end, line_number, column):
+        self.type_codes.append(TOKEN_TYPE_CODES[token_type])
+        self.starts.append(start)
+        self.ends.append(end)
+        self.line_numbers.append(line_number)
+        self.columns.append(column)
+
+    def type(self, i):
+        return TOKEN_TYPES[self.type_codes[i]]
+
+    def value(self, i):
+        value = self.source[self.starts[i]:self.ends[i]]
+        return int(value) if self.type_codes[i] == INT_CONSTANT_CODE else value
+
+
+class LineIndex:
+    """offsets at which the lines of a text start, built once so the line and column of any offset in the text
+    are found by bisection instead of counting newlines. Columns count characters from 1
+    """
+
+    def __init__(self, text, line_number=1, column=1):
+        """
+        Args:
+            text (str): text to index
+            line_number (int): line number of the first line of text
+            column (int): column of the first character of text, more than 1 if text starts inside a line
+        """
+        self.line_number = line_number
+        self.line_starts = [0]
+        newline = text.find(NEWLINE)
+        while newline != -1:
+            self.line_starts.append(newline + 1)
+            newline = text.find(NEWLINE, newline + 1)
+        # column = offset - column_bases[i] on the i-th line, the first one may not start at column 1
+        self._column_bases = [-column] + [line_start - 1 for line_start in self.line_starts[1:]]
+        # the line of the last position, most offsets asked for one after the other are on the same line
+        self._line = 0
+        self._line_end = self.line_starts[1] if len(self.line_starts) > 1 else len(text) + 1
+
+    def position(self, offset):
+        """
+        Returns:
+            tuple: line number and column of offset
+        """
+        if not self.line_starts[self._line] <= offset < self._line_end:
+            self._line = bisect.bisect_right(self.line_starts, offset) - 1
+            self._line_end = self.line_starts[self._line + 1] if self._line + 1 < len(self.line_starts) \
+                else float('inf')
+        return self.line_number + self._line, offset - self._column_bases[self._line]
+
+    def positions(self, offsets):
+        """position of each of the ascending offsets, with a bisection per line instead of one per offset
+        Returns:
+            tuple: list of the line numbers and list of the columns of offsets
+        """
+        line_numbers, columns = [], []
+        if not offsets:
+            return line_numbers, columns
+        line_starts = self.line_starts
+        first = bisect.bisect_right(line_starts, offsets[0]) - 1
+        last = bisect.bisect_right(line_starts, offsets[-1], first) - 1
+        start = 0  # index in offsets of the first offset on the line
+        for line in range(first, last + 1):
+            end = bisect.bisect_left(offsets, line_starts[line + 1], start) if line < last else len(offsets)
+            line_numbers.extend([self.line_number + line] * (end - start))
+            column_base = self._column_bases[line]
+            columns.extend([offset - column_base for offset in offsets[start:end]])
+            start = end
+        return line_numbers, columns
 
 
 class JackTokenizer:
@@ -87,7 +248,9 @@ class JackTokenizer:
     }
     # Note, order of these specifications matter
     tokens_specifications = {
-        'comment': r'//.*|/\*([^*]|[\r\n]|(\*+([^*/]|[\r\n])))*\*+/',
+        # no two alternatives match the same text, so an unterminated comment fails without backtracking
+        'comment': r'//.*|/\*(?:[^*]|\*+[^*/])*\*+/',
+        OPEN_COMMENT: r'/\*',  # of a comment not closed in the text, cut by its end or unterminated
         'space': r'[ \t]+',
         'newline': r'\n',
         SYMBOL: '|'.join([
@@ -106,30 +269,193 @@ class JackTokenizer:
             [r'(?P<{}>{})'.format(token, specification)
              for token, specification in tokens_specifications.items()]))
 
-    def __init__(self, in_stream):
+    def __init__(self, in_stream, chunk_size=READ_CHUNK_SIZE, diagnostics=None):
+        """
+        Args:
+            in_stream (str | file | mmap.mmap): jack source code, or a text file, binary file or mmap to read
+                it from in chunks, binary input is decoded as utf-8
+            chunk_size (int): size of the chunks read from in_stream if it is not a str
+            diagnostics (list): if given, wrong characters are appended to it as Diagnostic and skipped instead
+                of raising ParseException
+        """
         self.in_stream = in_stream
+        self.chunk_size = chunk_size
+        self.diagnostics = diagnostics
+        # position of the first character not tokenized yet
+        self.line_number = 1
+        self.column = 1
 
     def start_tokenizer(self):
-        line_number = 1
-        for m in self.jack_token.finditer(self.in_stream):
+        if isinstance(self.in_stream, str):
+            yield from self._scan(self.in_stream, final=True)
+            return
+
+        # only the tail of the previous chunk that may hold an unfinished token is kept around, inside a block
+        # comment only its last character, a * there may start the closing */
+        buffer = ''
+        comment_start = None  # line number and column of the block comment the buffer is inside of
+        for chunk in self._read_chunks():
+            buffer += chunk
+            if comment_start is not None:
+                close = buffer.find('*/')
+                if close == -1:
+                    buffer = self._skip(buffer, len(buffer) - 1)
+                    continue
+                buffer = self._skip(buffer, close + 2)
+                comment_start = None
+            consumed = yield from self._scan(buffer, final=False)
+            buffer = buffer[consumed:]
+            if buffer.startswith('/*'):  # _scan stopped at a block comment the chunk does not close
+                comment_start = self.line_number, self.column
+                buffer = self._skip(buffer, max(len(buffer) - 1, 2))
+        if comment_start is not None:
+            self._unterminated_comment(*comment_start)
+            return
+        yield from self._scan(buffer, final=True)
+
+    def tokenize_to_buffer(self):
+        """tokenize the whole source at once into a TokenBuffer
+        Returns:
+            TokenBuffer: tokens of the source
+        """
+        source = self._read_all()
+        token_buffer = TokenBuffer(source)
+        line_index = LineIndex(source, self.line_number, self.column)
+        append_type_code, append_start, append_end = \
+            token_buffer.type_codes.append, token_buffer.starts.append, token_buffer.ends.append
+        for m in self.jack_token.finditer(source):
             token_type = m.lastgroup
+            if token_type in ('space', 'newline', 'comment'):
+                continue
+            elif token_type == IDENTIFIER and m.group(token_type) in self.KEYWORDS:
+                token_type = KEYWORD
+            elif token_type == 'mismatch':
+                self._wrong_token(m.group(token_type), *line_index.position(m.start()))
+                continue
+            elif token_type == OPEN_COMMENT:
+                self._unterminated_comment(*line_index.position(m.start()))
+                break  # the rest of the source is inside the comment
+            append_type_code(TOKEN_TYPE_CODES[token_type])
+            append_start(m.start())
+            append_end(m.end())
+        # positions are computed for all the tokens at once
+        line_numbers, columns = line_index.positions(token_buffer.starts)
+        token_buffer.line_numbers.extend(line_numbers)
+        token_buffer.columns.extend(columns)
+        self.line_number, self.column = line_index.position(len(source))
+        return token_buffer
+
+    def _read_all(self):
+        if isinstance(self.in_stream, str):
+            return self.in_stream
+        return ''.join(self._read_chunks())
+
+    def _read_chunks(self):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = self.in_stream.read(self.chunk_size)
+            if not chunk:
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    yield tail
+                return
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            if chunk:  # empty if the chunk ended in the middle of a multibyte character
+                yield chunk
+
+    def _scan(self, text, final):
+        """yield the tokens of text, if not final stop before the first token that may continue past its end
+        Returns:
+            int: index in text of the first character that was not tokenized
+        """
+        line_index = LineIndex(text, self.line_number, self.column)
+        end = consumed = len(text)
+        # the positions of a batch of tokens are computed at once, a batch is yielded before any wrong token
+        token_types, token_values, starts = [], [], []
+        for m in self.jack_token.finditer(text):
+            token_type = m.lastgroup
+            if token_type in ('space', 'newline', 'comment'):
+                if not final and m.end() == end and token_type == 'comment' and m.group(token_type)[1] == '/':
+                    consumed = m.start()  # the line comment may go on in the next chunk
+                    break
+                continue
+            if token_type == OPEN_COMMENT:
+                if not final:
+                    consumed = m.start()
+                    break
+                yield from self._positioned_tokens(token_types, token_values, starts, line_index)
+                token_types, token_values, starts = [], [], []
+                self._unterminated_comment(*line_index.position(m.start()))
+                break  # the rest of the text is inside the comment
             token_value = m.group(token_type)
+            if not final and (m.end() == end or token_value == DOUBLE_QUOTES and self._is_cut(text, m.start(), end)):
+                consumed = m.start()
+                break
             if token_type == 'integerConstant':
                 token_value = int(token_value)
             elif token_type == IDENTIFIER and token_value in self.KEYWORDS:
                 token_type = KEYWORD
-            elif token_type == 'newline':
-                line_number += 1
-                continue
-            elif token_type in ('space', 'comment'):
-                continue
             elif token_type == 'mismatch':
-                raise ParseException(
-                    f'got wrong jack token: {token_value} in line {line_number}')
-            yield Token(token_type, token_value, line_number)
+                yield from self._positioned_tokens(token_types, token_values, starts, line_index)
+                token_types, token_values, starts = [], [], []
+                self._wrong_token(token_value, *line_index.position(m.start()))
+                continue
+            token_types.append(token_type)
+            token_values.append(token_value)
+            starts.append(m.start())
+            if len(starts) == TOKEN_BATCH_SIZE:
+                yield from self._positioned_tokens(token_types, token_values, starts, line_index)
+                token_types, token_values, starts = [], [], []
+        yield from self._positioned_tokens(token_types, token_values, starts, line_index)
+        self.line_number, self.column = line_index.position(consumed)
+        return consumed
+
+    @staticmethod
+    def _positioned_tokens(token_types, token_values, starts, line_index):
+        # tuple.__new__ builds each Token without the python level Token.__new__, the tokenizer spends about 15%
+        # less time than with map(Token, ...) on a class of 127k tokens
+        return map(tuple.__new__, repeat(Token), zip(token_types, token_values, *line_index.positions(starts)))
+
+    def _skip(self, text, end):
+        """move the position past text[:end], which holds no token
+        Returns:
+            str: the rest of text
+        """
+        newlines = text.count(NEWLINE, 0, end)
+        if newlines:
+            self.line_number += newlines
+            self.column = end - text.rfind(NEWLINE, 0, end)
+        else:
+            self.column += end
+        return text[end:]
 
+    def _unterminated_comment(self, line_number, column):
+        """report a block comment that is never closed, like _wrong_token"""
+        if self.diagnostics is None:
+            raise ParseException(f'unterminated comment in line {line_number}, column {column}')
+        self.diagnostics.append(Diagnostic(line_number, 'unterminated comment', column))
 
-class CompilationEngine:
+    def _wrong_token(self, value, line_number, column):
+        """report a character no token starts with
+        Raises:
+            ParseException: unless diagnostics are collected
+        """
+        if self.diagnostics is None:
+            raise ParseException(f'got wrong jack token: {value} in line {line_number}, column {column}')
+        self.diagnostics.append(Diagnostic(line_number, f'got wrong jack token: {value}', column))
+
+    @staticmethod
+    def _is_cut(text, start, end):
+        """whether the " at start may begin a string constant that text[:end] cuts short"""
+        return text[start] == DOUBLE_QUOTES and text.find(DOUBLE_QUOTES, start + 1, end) == -1 \
+            and text.find(NEWLINE, start + 1, end) == -1
+
+
+class XmlEmitter:
+    """writes the xml parse tree lines, collected in a list and written out to out_stream in large blocks
+    the indented text around a tag is built once for every tag and indent level
+    """
     special_xml = {
         LESS_THAN: '&lt;',
         GREATER_THAN: '&gt;',
@@ -137,18 +463,464 @@ class CompilationEngine:
         DOUBLE_QUOTES: '&quot;'
     }
 
-    def __init__(self, tokens_stream, out_stream):
+    def __init__(self, out_stream, flush_lines=EMITTER_FLUSH_LINES):
+        """
+        Args:
+            out_stream (stream): file to write the xml into
+            flush_lines (int): number of lines collected before they are written to out_stream
+        """
+        self.out_stream = out_stream
+        self.flush_lines = flush_lines
+        self.lines = []
+        self._open_lines = {}
+        self._close_lines = {}
+        self._value_affixes = {}
+
+    @staticmethod
+    def _indent(level):
+        return ' ' * INDENT_NUM_SPACES * level
+
+    def tag_value(self, tag, value, level):
+        """
+        Args:
+            tag (str): type of token
+            value (str | integer): value of token
+            level (int): indent level
+        """
+        try:
+            prefix, suffix = self._value_affixes[tag, level]
+        except KeyError:
+            prefix, suffix = self._value_affixes[tag, level] = (f'{self._indent(level)}<{tag}> ', f' </{tag}>{NEWLINE}')
+        self.lines.append(f'{prefix}{self.special_xml.get(value, value)}{suffix}')
+        if len(self.lines) >= self.flush_lines:
+            self.flush()
+
+    # only tag_value flushes, there is at most one line per nesting level between two tag values
+    def open_tag(self, tag, level):
+        try:
+            self.lines.append(self._open_lines[tag, level])
+        except KeyError:
+            self.lines.append(self._open_lines.setdefault((tag, level), f'{self._indent(level)}<{tag}>{NEWLINE}'))
+
+    def close_tag(self, tag, level):
+        try:
+            self.lines.append(self._close_lines[tag, level])
+        except KeyError:
+            self.lines.append(self._close_lines.setdefault((tag, level), f'{self._indent(level)}</{tag}>{NEWLINE}'))
+
+    def flush(self):
+        self.out_stream.write(''.join(self.lines))
+        self.lines.clear()
+
+
+class Node:
+    """non-terminal of the parse tree, like class, letStatement or expression"""
+    __slots__ = ('kind', 'line_number', 'children')
+
+    def __init__(self, kind, line_number, children=None):
+        self.kind = kind
+        self.line_number = line_number  # of its first token
+        self.children = [] if children is None else children
+
+    def __repr__(self):
+        return f'Node({self.kind!r}, {self.line_number}, <{len(self.children)} children>)'
+
+    def to_dict(self):
+        """json serializable form of the subtree, built with a stack as the tree may be deeper than the recursion
+        limit
+        """
+        subtree = {'kind': self.kind, 'line_number': self.line_number, 'children': []}
+        stack = [(self, subtree['children'])]
+        while stack:
+            node, children = stack.pop()
+            for child in node.children:
+                if isinstance(child, Node):
+                    child_dict = {'kind': child.kind, 'line_number': child.line_number, 'children': []}
+                    stack.append((child, child_dict['children']))
+                else:
+                    child_dict = child.to_dict()
+                children.append(child_dict)
+        return subtree
+
+
+class Leaf:
+    """terminal of the parse tree, one token"""
+    __slots__ = ('kind', 'value', 'line_number')
+
+    def __init__(self, kind, value, line_number):
+        self.kind = kind  # token type
+        self.value = value  # as written to xml, without the quotes of string constants
+        self.line_number = line_number
+
+    def __repr__(self):
+        return f'Leaf({self.kind!r}, {self.value!r}, {self.line_number})'
+
+    def to_dict(self):
+        return {'kind': self.kind, 'value': self.value, 'line_number': self.line_number}
+
+
+class AstBuilder:
+    """emitter that builds the parse tree of the class in memory instead of writing xml"""
+
+    def __init__(self, line_number):
+        """
+        Args:
+            line_number (Callable): returns the line number of the current token, like
+                CompilationEngine.current_line_number
+        """
+        self.line_number = line_number
+        self.root = None
+        self._open_nodes = []
+
+    def tag_value(self, tag, value, level):
+        self._open_nodes[-1].children.append(Leaf(tag, value, self.line_number()))
+
+    def open_tag(self, tag, level):
+        node = Node(tag, self.line_number())
+        if self._open_nodes:
+            self._open_nodes[-1].children.append(node)
+        else:
+            self.root = node
+        self._open_nodes.append(node)
+
+    def close_tag(self, tag, level):
+        self._open_nodes.pop()
+
+    def flush(self):
+        pass
+
+
+def build_ast(tokens, engine_class=None):
+    """parse a jack class into its parse tree
+    Args:
+        tokens (Generator | TokenBuffer): tokens of the class
+        engine_class (type): CompilationEngine subclass to parse with, None for BufferedCompilationEngine
+            if tokens is a TokenBuffer and CompilationEngine otherwise
+    Returns:
+        Node: the class node, None if there are no tokens
+    """
+    if engine_class is None:
+        engine_class = BufferedCompilationEngine if isinstance(tokens, TokenBuffer) else CompilationEngine
+    compilation_engine = engine_class(tokens, None, AstBuilder(None))
+    compilation_engine.emitter.line_number = compilation_engine.current_line_number
+    compilation_engine.compile_class()
+    return compilation_engine.emitter.root
+
+
+def write_xml(node, out_stream):
+    """serialize a parse tree built by AstBuilder to the same xml CompilationEngine writes"""
+    emitter = XmlEmitter(out_stream)
+    pending = [(node, 0)]  # nodes still to write, and the kinds of open nodes still to close
+    while pending:
+        node, level = pending.pop()
+        if isinstance(node, str):  # the kind of a node whose children are all written
+            emitter.close_tag(node, level)
+        elif isinstance(node, (Leaf, BinaryLeaf)):
+            emitter.tag_value(node.kind, node.value, level)
+        else:
+            emitter.open_tag(node.kind, level)
+            pending.append((node.kind, level))
+            pending.extend((child, level + 1) for child in reversed(node.children))
+    emitter.flush()
+
+
+def write_tokens(tokens, out_stream, token_format='xml', flush_lines=EMITTER_FLUSH_LINES):
+    """write tokens without parsing them, as the <tokens> xml of the nand2tetris T.xml files or as json lines of
+    [type, value, line_number, column], string constants are written without their quotes in both
+    Args:
+        tokens (Iterable): Token of a class, like JackTokenizer.start_tokenizer
+        out_stream (stream): file to write into
+        token_format (str): xml or jsonl
+        flush_lines (int): number of lines collected before they are written to out_stream
+    """
+    if token_format == 'jsonl':
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        lines = []
+        for token_type, value, line_number, column in tokens:
+            # only string constants may hold characters json escapes
+            if token_type == STR_CONSTANT:
+                value = encode(value.strip(DOUBLE_QUOTES))
+            elif token_type != INT_CONSTANT:
+                value = f'"{value}"'
+            lines.append(f'["{token_type}",{value},{line_number},{column}]{NEWLINE}')
+            if len(lines) >= flush_lines:
+                out_stream.write(''.join(lines))
+                lines.clear()
+        out_stream.write(''.join(lines))
+        return
+    emitter = XmlEmitter(out_stream, flush_lines)
+    emitter.open_tag('tokens', 0)
+    for token_type, value, _, _ in tokens:
+        emitter.tag_value(token_type, value.strip(DOUBLE_QUOTES) if token_type == STR_CONSTANT else value, 0)
+    emitter.close_tag('tokens', 0)
+    emitter.flush()
+
+
+# Binary format of a token stream and parse tree, all integers are unsigned LEB128 varints:
+#   BINARY_MAGIC, then three sections each prefixed with its length in bytes
+#   strings: count, then the utf-8 length and bytes of every distinct token value and node kind
+#   tokens: count, then type code, value string index, line number increase over the previous token and column
+#   of each
+#   tree: the root in preorder, empty without one. A node is kind string index << 1, its line number increase over
+#   its parent, the length in bytes of its children and the children. A leaf is kind string index << 1 | 1, line
+#   number increase and value string index
+# so the tree can be walked from a mmap, skipping the subtrees that are not asked for
+BINARY_MAGIC = b'JKB\x02'
+
+
+def _append_varint(out, n):
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _varint_size(n):
+    return (max(n.bit_length(), 1) + 6) // 7
+
+
+def _read_varint(buffer, pos):
+    """
+    Returns:
+        tuple: the varint at pos in buffer, and the position after it
+    """
+    byte = buffer[pos]
+    n = byte & 0x7f
+    shift = 7
+    while byte & 0x80:
+        pos += 1
+        byte = buffer[pos]
+        n |= (byte & 0x7f) << shift
+        shift += 7
+    return n, pos + 1
+
+
+def dump_binary(tokens, root, out_stream):
+    """write tokens and a parse tree built by AstBuilder in the binary format
+    Args:
+        tokens (Iterable): Token of the class, like a TokenBuffer
+        root (Node): the class node, None for none
+        out_stream (stream): binary file to write to
+    """
+    strings = {}  # string: its index
+
+    def index(value):
+        return strings.setdefault(str(value), len(strings))
+
+    token_section = bytearray()
+    count_tokens = 0
+    line_number = 0
+    for token_type, value, token_line_number, column in tokens:
+        _append_varint(token_section, TOKEN_TYPE_CODES[token_type])
+        _append_varint(token_section, index(value))
+        _append_varint(token_section, token_line_number - line_number)
+        _append_varint(token_section, column)
+        line_number = token_line_number
+        count_tokens += 1
+
+    # the children length of every node, computed bottom up before writing top down
+    children_sizes = {}
+    if root is not None:
+        pending = [(root, 0, False)]
+        while pending:
+            node, parent_line_number, children_done = pending.pop()
+            if not children_done:
+                pending.append((node, parent_line_number, True))
+                pending.extend((child, node.line_number, False) for child in node.children if isinstance(child, Node))
+                continue
+            size = 0
+            for child in node.children:
+                line_delta = _varint_size(child.line_number - node.line_number)
+                if isinstance(child, Node):
+                    child_size = children_sizes[id(child)]
+                    size += _varint_size(index(child.kind) << 1) + line_delta + _varint_size(child_size) + child_size
+                else:
+                    size += _varint_size(index(child.kind) << 1 | 1) + line_delta + _varint_size(index(child.value))
+            children_sizes[id(node)] = size
+
+    tree_section = bytearray()
+    pending = [] if root is None else [(root, 0)]
+    while pending:
+        node, parent_line_number = pending.pop()
+        if isinstance(node, Node):
+            _append_varint(tree_section, index(node.kind) << 1)
+            _append_varint(tree_section, node.line_number - parent_line_number)
+            _append_varint(tree_section, children_sizes[id(node)])
+            pending.extend((child, node.line_number) for child in reversed(node.children))
+        else:
+            _append_varint(tree_section, index(node.kind) << 1 | 1)
+            _append_varint(tree_section, node.line_number - parent_line_number)
+            _append_varint(tree_section, index(node.value))
+
+    string_section = bytearray()
+    _append_varint(string_section, len(strings))
+    for string in strings:  # in index order
+        data = string.encode()
+        _append_varint(string_section, len(data))
+        string_section += data
+    header = bytearray(BINARY_MAGIC)
+    _append_varint(header, len(string_section))
+    out_stream.write(header)
+    out_stream.write(string_section)
+    section = bytearray()
+    _append_varint(section, len(token_section) + _varint_size(count_tokens))
+    _append_varint(section, count_tokens)
+    out_stream.write(section)
+    out_stream.write(token_section)
+    section.clear()
+    _append_varint(section, len(tree_section))
+    out_stream.write(section)
+    out_stream.write(tree_section)
+
+
+class BinaryDocument:
+    """tokens and parse tree read from the binary format written by dump_binary
+    only the strings are decoded up front, tokens and tree nodes are decoded as they are walked
+    """
+
+    def __init__(self, buffer):
+        """
+        Args:
+            buffer (bytes | mmap.mmap): the binary format
+        Raises:
+            ValueError: if buffer does not start with BINARY_MAGIC
+        """
+        if buffer[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError('not a jack binary token stream and parse tree')
+        self.buffer = buffer
+        size, pos = _read_varint(buffer, len(BINARY_MAGIC))
+        count_strings, string_pos = _read_varint(buffer, pos)
+        self.strings = []
+        for _ in range(count_strings):
+            length, string_pos = _read_varint(buffer, string_pos)
+            self.strings.append(bytes(buffer[string_pos:string_pos + length]).decode())
+            string_pos += length
+        size, pos = _read_varint(buffer, pos + size)
+        self._tokens_start = pos
+        size, pos = _read_varint(buffer, pos + size)
+        self._tree_start, self._tree_end = pos, pos + size
+
+    def tokens(self):
+        buffer = self.buffer
+        strings = self.strings
+        count_tokens, pos = _read_varint(buffer, self._tokens_start)
+        line_number = 0
+        for _ in range(count_tokens):
+            code, pos = _read_varint(buffer, pos)
+            value, pos = _read_varint(buffer, pos)
+            line_delta, pos = _read_varint(buffer, pos)
+            column, pos = _read_varint(buffer, pos)
+            line_number += line_delta
+            value = strings[value]
+            yield Token(TOKEN_TYPES[code], int(value) if code == INT_CONSTANT_CODE else value, line_number, column)
+
+    @property
+    def root(self):
+        """BinaryNode: the class node, None if the source has no tokens"""
+        if self._tree_start == self._tree_end:
+            return None
+        return self._decode(self._tree_start, 0)[0]
+
+    def _decode(self, pos, parent_line_number):
+        """
+        Returns:
+            tuple: BinaryNode or BinaryLeaf at pos, and the position after it
+        """
+        buffer = self.buffer
+        kind, pos = _read_varint(buffer, pos)
+        line_delta, pos = _read_varint(buffer, pos)
+        value, pos = _read_varint(buffer, pos)
+        if kind & 1:
+            kind = self.strings[kind >> 1]
+            value = self.strings[value]
+            return BinaryLeaf(kind, int(value) if kind == INT_CONSTANT else value,
+                              parent_line_number + line_delta), pos
+        return BinaryNode(self, self.strings[kind >> 1], parent_line_number + line_delta, pos, pos + value), pos + value
+
+
+class BinaryNode:
+    """node of a BinaryDocument parse tree, whose children are decoded when asked for"""
+    __slots__ = ('document', 'kind', 'line_number', '_start', '_end')
+
+    def __init__(self, document, kind, line_number, start, end):
+        self.document = document
+        self.kind = kind
+        self.line_number = line_number
+        self._start = start  # of its children in the document buffer
+        self._end = end
+
+    def __repr__(self):
+        return f'BinaryNode({self.kind!r}, {self.line_number})'
+
+    @property
+    def children(self):
+        children = []
+        pos = self._start
+        while pos < self._end:
+            child, pos = self.document._decode(pos, self.line_number)
+            children.append(child)
+        return children
+
+    def to_node(self):
+        """the subtree decoded into Node and Leaf"""
+        root = Node(self.kind, self.line_number)
+        pending = [(self, root)]
+        while pending:
+            binary_node, node = pending.pop()
+            for child in binary_node.children:
+                if isinstance(child, BinaryLeaf):
+                    node.children.append(Leaf(child.kind, child.value, child.line_number))
+                else:
+                    node.children.append(Node(child.kind, child.line_number))
+                    pending.append((child, node.children[-1]))
+        return root
+
+
+class BinaryLeaf(NamedTuple):
+    kind: str
+    value: object
+    line_number: int
+
+
+def binary_to_xml(buffer, out_stream):
+    """write the parse tree of the binary format as the xml CompilationEngine writes"""
+    root = BinaryDocument(buffer).root
+    if root is not None:
+        write_xml(root, out_stream)
+
+
+class CompilationEngine:
+    def __init__(self, tokens_stream, out_stream, emitter=None, diagnostics=None):
         """ initialize the compilation engine which parses tokens from tokensStream and write in outFileStream
         INVARIANT: current_token is the token we are handling now given _eat() is last to run in handling it
         Args:
             tokens_stream (Generator): Generator of jack tokens
             out_stream (stream): file to write parsed jack code into
+            emitter (XmlEmitter): what the parse tree is written with, None for an XmlEmitter on out_stream
+            diagnostics (list): if given, syntax errors are appended to it as Diagnostic and parsing resumes at
+                the next statement or class member instead of raising ParseException, the output is then
+                incomplete
         """
         self.tokens_stream = tokens_stream
         self.out_stream = out_stream
+        self.emitter = emitter or XmlEmitter(out_stream)
+        self.diagnostics = diagnostics
         self.current_token = None
         self.indent_level = 0
 
+    def _advance(self):
+        """move current_token to the next token
+        Raises:
+            StopIteration: if there are no more tokens
+        """
+        self.current_token = next(self.tokens_stream)
+
+    def current_line_number(self):
+        return self.current_token.line_number
+
+    def current_column(self):
+        return self.current_token.column
+
     @property
     def current_token_value(self):
         return self.current_token.value
@@ -169,25 +941,21 @@ class CompilationEngine:
             tag (str): type of token
             value (str | integer): value of token
         """
-        value = self.special_xml.get(value, value)
-        indent = ' ' * INDENT_NUM_SPACES * self.indent_level
-        self.out_stream.write(f'{indent}<{tag}> {value} </{tag}>{NEWLINE}')
+        self.emitter.tag_value(tag, value, self.indent_level)
 
     def _write_open_tag(self, tag):
         """writes xml open tag with given tag
         Args:
             tag (str): xml tag
         """
-        indent = ' ' * INDENT_NUM_SPACES * self.indent_level
-        self.out_stream.write(f'{indent}<{tag}>{NEWLINE}')
+        self.emitter.open_tag(tag, self.indent_level)
 
     def _write_close_tag(self, tag):
         """writes xml close tag with given tag
         Args:
             tag (str): xml tag
         """
-        indent = ' ' * INDENT_NUM_SPACES * self.indent_level
-        self.out_stream.write(f'{indent}</{tag}>{NEWLINE}')
+        self.emitter.close_tag(tag, self.indent_level)
 
     def _eat(self, s):
         """advance to next token if given string is same as the current token, otherwise raise error
@@ -199,21 +967,86 @@ class CompilationEngine:
         if s == self.current_token_value or \
                 (s == self.current_token_type and s in {INT_CONSTANT, STR_CONSTANT, IDENTIFIER}):
             try:
-                self.current_token = next(self.tokens_stream)
+                self._advance()
             except StopIteration:
                 if s != RIGHT_BRACE:  # last token
                     raise ParseException(f'Error, reached end of file\n{str(self.current_token)}')
         else:
+            # the token on the second line gives where, only the first line goes into a Diagnostic
             raise ParseException(
-                f'Got wrong token in line {self.current_token.line_number}: '
-                f'{self.current_token_value}, expected: {s!r}\n{str(self.current_token)}')
+                f'Got wrong token: {self.current_token_value}, expected: {s!r}\n{str(self.current_token)}')
+
+    def _report(self, error):
+        self.diagnostics.append(
+            Diagnostic(self.current_line_number(), str(error).partition(NEWLINE)[0], self.current_column()))
+
+    def _recovering(self, compile_function, synchronize):
+        """call compile_function, on a syntax error report it and skip tokens with synchronize to where
+        compiling can go on
+        Raises:
+            StopIteration: if the tokens run out while skipping
+        """
+        indent_level = self.indent_level
+        try:
+            compile_function()
+        except ParseException as e:
+            self._report(e)
+            self.indent_level = indent_level
+            synchronize()
+
+    def _skip_to_statement(self):
+        """skip to the start of the next statement, after a ';' or a whole block, or to the '}' closing the
+        enclosing block
+        """
+        depth = 0
+        while True:
+            value = self.current_token_value
+            if value == LEFT_BRACE:
+                depth += 1
+            elif value == RIGHT_BRACE:
+                if depth == 0:
+                    return
+                depth -= 1
+                if depth == 0:
+                    self._advance()
+                    if self.current_token_value != ELSE:
+                        return
+                    continue
+            elif depth == 0:
+                if value == SEMI_COLON:
+                    self._advance()
+                    return
+                if value in STATEMENT_KEYWORDS:
+                    return
+            self._advance()
+
+    def _skip_stray_token(self):
+        """report the current token, which starts no statement where one was expected, and skip past it"""
+        self._report(ParseException(f'Got wrong token: {self.current_token_value}, expected a statement'))
+        self._skip_to_statement()
+
+    def _skip_to_class_member(self):
+        while self.current_token_value not in CLASS_MEMBER_KEYWORDS:
+            self._advance()
 
     def compile_class(self):
         """Starting point in compiling a jack source file
         """
+        if self.diagnostics is None:
+            self._compile_class()
+            return
+        try:
+            self._compile_class()
+        except ParseException as e:  # outside of the class members there is nothing to resume at
+            self._report(e)
+        except StopIteration:  # the tokens ran out while skipping past an error
+            pass
+
+    def _compile_class(self):
         # first token
         try:
-            self.current_token = self.current_token or next(self.tokens_stream)
+            if self.current_token is None:
+                self._advance()
         except StopIteration:  # jack source file is empty
             return
 
@@ -235,11 +1068,17 @@ class CompilationEngine:
 
         # classVarDec*
         while self.current_token_value in {STATIC, FIELD}:
-            self.compile_class_var_dec()
+            if self.diagnostics is None:
+                self.compile_class_var_dec()
+            else:
+                self._recovering(self.compile_class_var_dec, self._skip_to_class_member)
 
         # subroutineDec*
         while self.current_token_value in {CONSTRUCTOR, FUNCTION, METHOD}:
-            self.compile_subroutine_dec()
+            if self.diagnostics is None:
+                self.compile_subroutine_dec()
+            else:
+                self._recovering(self.compile_subroutine_dec, self._skip_to_class_member)
 
         # }
         self._write_tag_value(SYMBOL, self.current_token_value)
@@ -248,6 +1087,7 @@ class CompilationEngine:
         # </class>
         self.deindent()
         self._write_close_tag(CLASS)
+        self.emitter.flush()
 
     def compile_class_var_dec(self):
         """compile a jack class variable declarations
@@ -372,7 +1212,10 @@ class CompilationEngine:
         self._eat(LEFT_BRACE)
 
         while self.current_token_value == VAR:  # order matters, simplify
-            self.compile_var_dec()
+            if self.diagnostics is None:
+                self.compile_var_dec()
+            else:
+                self._recovering(self.compile_var_dec, self._skip_to_statement)
 
         self.compile_statements()
 
@@ -410,14 +1253,24 @@ class CompilationEngine:
         self._write_open_tag('statements')
         self.reindent()
 
-        while self.current_token_value in {LET, IF, WHILE, DO, RETURN}:
-            {
+        while True:
+            if self.current_token_value not in {LET, IF, WHILE, DO, RETURN}:
+                # statements end at the closing brace, anything else is reported and skipped when recovering
+                if self.diagnostics is None or self.current_token_value == RIGHT_BRACE:
+                    break
+                self._skip_stray_token()
+                continue
+            compile_statement = {
                 LET: self.compile_let_statement,
                 IF: self.compile_if_statement,
                 WHILE: self.compile_while_statement,
                 DO: self.compile_do_statement,
                 RETURN: self.compile_return_statement,
-            }[self.current_token_value]()
+            }[self.current_token_value]
+            if self.diagnostics is None:
+                compile_statement()
+            else:
+                self._recovering(compile_statement, self._skip_to_statement)
 
         # </statements>
         self.deindent()
@@ -596,134 +1449,2101 @@ class CompilationEngine:
         """
         compile jack expression
         """
+        self._compile_expression_tree(EXPRESSION)
 
-        # <expression>
-        self._write_open_tag('expression')
-        self.reindent()
+    def compile_term(self):
+        """
+        compile jack term
+        """
+        self._compile_expression_tree(TERM)
+
+    def compile_expression_list(self):
+        """
+        compile jack expression list
+        """
+        self._compile_expression_tree(EXPRESSION_LIST)
+
+    def _compile_expression_tree(self, production):
+        """compile an expression, term or expression list and everything nested in it, keeping what is left to do
+        in the enclosing productions on an explicit stack instead of in python frames, so nesting depth is only
+        bounded by memory
+        grammar:
+            expression: term (op term)*
+            term: integerConstant | stringConstant | keywordConstant | varName | varName '[' expression ']' |
+                  subroutineCall | '(' expression ')' | unaryOp term
+            subroutineCall: subroutineName '(' expressionList ')' |
+                            (className | varName) '.' subroutineName '(' expressionList ')'
+            expressionList: (expression (',' expression)*)?
+        Args:
+            production (int): EXPRESSION, TERM or EXPRESSION_LIST
+        """
+        emitter = self.emitter
+        tag_value = emitter.tag_value
+        open_tag = emitter.open_tag
+        close_tag = emitter.close_tag
+        eat = self._eat
+        level = self.indent_level
+        stack = []
+        while True:
+            if production == EXPRESSION:
+                # <expression> term (op term)*
+                open_tag('expression', level)
+                level += 1
+                stack.append(_MORE_TERMS)
+                production = TERM
+
+            if production == TERM:
+                # <term>
+                open_tag('term', level)
+                level += 1
+                token_type = self.current_token_type
+                value = self.current_token_value
+                if token_type == INT_CONSTANT:
+                    tag_value('integerConstant', value, level)
+                    eat(INT_CONSTANT)
+                elif token_type == STR_CONSTANT:
+                    tag_value('stringConstant', value.strip(DOUBLE_QUOTES), level)
+                    eat(STR_CONSTANT)
+                elif value in KEYWORD_CONSTANT:
+                    tag_value(KEYWORD, value, level)
+                    eat(value)
+                elif value in UNARY_OP:  # unaryOp term, this term is closed after the nested one
+                    tag_value(SYMBOL, value, level)
+                    eat(value)
+                    stack.append(_CLOSE_TERM)
+                    continue
+                elif value == LEFT_PAREN:  # '(' expression ')'
+                    tag_value(SYMBOL, LEFT_PAREN, level)
+                    eat(LEFT_PAREN)
+                    stack.append(_CLOSE_TERM)
+                    stack.append(_CLOSE_PAREN)
+                    production = EXPRESSION
+                    continue
+                else:  # identifier, what follows it tells apart the kinds of term
+                    tag_value(IDENTIFIER, value, level)
+                    eat(IDENTIFIER)
+                    next_token_value = self.current_token_value
+
+                    # varName'[' expression ']'
+                    if next_token_value == LEFT_BRACKET:
+                        tag_value(SYMBOL, LEFT_BRACKET, level)
+                        eat(LEFT_BRACKET)
+                        stack.append(_CLOSE_TERM)
+                        stack.append(_CLOSE_BRACKET)
+                        production = EXPRESSION
+                        continue
+                    # subroutineCall: foo.bar(expressionList) | Foo.bar(expressionList) | bar(expressionList)
+                    if next_token_value == DOT or next_token_value == LEFT_PAREN:
+                        if next_token_value == DOT:
+                            tag_value(SYMBOL, DOT, level)
+                            eat(DOT)
+                            tag_value(IDENTIFIER, self.current_token_value, level)
+                            eat(IDENTIFIER)
+                        tag_value(SYMBOL, LEFT_PAREN, level)
+                        eat(LEFT_PAREN)
+                        stack.append(_CLOSE_TERM)
+                        stack.append(_CLOSE_PAREN)
+                        production = EXPRESSION_LIST
+                        continue
+                    # foo
+                # </term>
+                level -= 1
+                close_tag('term', level)
+
+            elif production == EXPRESSION_LIST:
+                # <expressionList> (expression (',' expression)*)?
+                open_tag('expressionList', level)
+                level += 1
+                if self.current_token_value != RIGHT_PAREN:
+                    stack.append(_MORE_EXPRESSIONS)
+                    production = EXPRESSION
+                    continue
+                # </expressionList>
+                level -= 1
+                close_tag('expressionList', level)
+
+            elif production == _MORE_TERMS:
+                value = self.current_token_value
+                if value in OP:
+                    tag_value(SYMBOL, value, level)
+                    eat(value)
+                    stack.append(_MORE_TERMS)
+                    production = TERM
+                    continue
+                # </expression>
+                level -= 1
+                close_tag('expression', level)
+
+            elif production == _CLOSE_TERM:
+                # </term>
+                level -= 1
+                close_tag('term', level)
+
+            elif production == _CLOSE_PAREN:
+                tag_value(SYMBOL, RIGHT_PAREN, level)
+                eat(RIGHT_PAREN)
+
+            elif production == _CLOSE_BRACKET:
+                tag_value(SYMBOL, RIGHT_BRACKET, level)
+                eat(RIGHT_BRACKET)
+
+            else:  # _MORE_EXPRESSIONS
+                if self.current_token_value == COMMA:
+                    tag_value(SYMBOL, COMMA, level)
+                    eat(COMMA)
+                    stack.append(_MORE_EXPRESSIONS)
+                    production = EXPRESSION
+                    continue
+                # </expressionList>
+                level -= 1
+                close_tag('expressionList', level)
+
+            if not stack:
+                self.indent_level = level
+                return
+            production = stack.pop()
+
+
+class BufferedCompilationEngine(CompilationEngine):
+    """CompilationEngine reading tokens straight out of a TokenBuffer, without creating a Token for each"""
+
+    def __init__(self, token_buffer, out_stream, emitter=None, start=0, stop=None, diagnostics=None):
+        """
+        Args:
+            token_buffer (TokenBuffer): tokens to parse
+            out_stream (stream): file to write parsed jack code into
+            emitter (XmlEmitter): what the parse tree is written with, None for an XmlEmitter on out_stream
+            start (int): index in token_buffer of the first token to parse
+            stop (int): index in token_buffer after the last token to parse, None for its end
+            diagnostics (list): as for CompilationEngine
+        """
+        super().__init__(None, out_stream, emitter, diagnostics)
+        self.token_buffer = token_buffer
+        self.index = start - 1
+        self.stop = len(token_buffer) if stop is None else stop
+        self._type = None
+        self._value = None
+
+    def _advance(self):
+        if self.index + 1 >= self.stop:
+            raise StopIteration
+        self.index += 1
+        self._type = self.token_buffer.type(self.index)
+        self._value = self.token_buffer.value(self.index)
+
+    def current_line_number(self):
+        return self.token_buffer.line_numbers[self.index]
+
+    def current_column(self):
+        return self.token_buffer.columns[self.index]
 
-        # term
-        self.compile_term()
+    @property
+    def current_token(self):
+        return self.token_buffer[self.index] if self._type is not None else None
 
-        # (op term)*
-        while self.current_token_value in OP:
-            self._write_tag_value(SYMBOL, self.current_token_value)
-            self._eat(self.current_token_value)
-            self.compile_term()
+    @current_token.setter
+    def current_token(self, token):  # only reset to None by CompilationEngine.__init__
+        if token is not None:
+            raise AttributeError('current_token of a BufferedCompilationEngine follows its token_buffer')
 
-        # </expression>
-        self.deindent()
-        self._write_close_tag('expression')
+    @property
+    def current_token_value(self):
+        return self._value
 
-    def compile_term(self):
+    @property
+    def current_token_type(self):
+        return self._type
+
+
+
+class _Segment:
+    """a part of the source parsed on its own: the class header with its classVarDecs, one subroutineDec, or
+    the closing brace, each with the whitespace and comments following it
+    """
+    __slots__ = ('start', 'end', 'line_number', 'tokens', 'nodes', 'line_offset')
+
+    def __init__(self, start, end, line_number, tokens, nodes):
+        self.start = start  # offset in the source
+        self.end = end
+        self.line_number = line_number  # line number at start
+        self.tokens = tokens  # TokenBuffer of source[start:end]
+        self.nodes = nodes  # children of the class node
+        self.line_offset = 0  # not yet added to the line numbers of tokens and nodes
+
+
+class IncrementalParser:
+    """parse tree of a jack class kept up to date with edits of its source
+    an edit inside subroutines re-tokenizes and re-parses only those subroutines, the rest of the tree is
+    reused and its line numbers are shifted only once the tree or tokens are asked for. Edits elsewhere, or ones
+    that change where subroutines start and end, parse the whole source again
+    """
+    SUBROUTINE_KEYWORDS = {CONSTRUCTOR, FUNCTION, METHOD}
+
+    def __init__(self, source):
         """
-        compile jack term
+        Args:
+            source (str): jack source code
+        Raises:
+            ParseException: if the source is not valid jack
         """
+        self.source = source
+        self.root = None
+        self._segments = None
+        self._parse()
 
-        # <term>
-        self._write_open_tag('term')
-        self.reindent()
+    @property
+    def tree(self):
+        """Node: the class node, None if the source has no tokens"""
+        for segment in self._segments:
+            if segment.line_offset:
+                self._shift_lines(segment)
+        return self.root
+
+    def tokens(self):
+        """tokens of the source, like JackTokenizer.start_tokenizer"""
+        for segment in self._segments:
+            if segment.line_offset:
+                self._shift_lines(segment)
+            yield from segment.tokens
+
+    def write_xml(self, out_stream):
+        """write the parse tree as CompilationEngine would"""
+        if self.root is not None:
+            write_xml(self.root, out_stream)
+
+    def edit(self, start, end, text):
+        """replace source[start:end] with text and update the parse tree
+        Returns:
+            bool: True if only the edited subroutines were parsed again
+        Raises:
+            ParseException: if the edited source is not valid jack, a later edit then parses the whole source
+        """
+        old_source = self.source
+        self.source = old_source[:start] + text + old_source[end:]
+        if self._segments is not None and self._reparse_subroutines(old_source, start, end, len(text)):
+            return True
+        self._parse()
+        return False
+
+    def _parse(self):
+        self.root = self._segments = None
+        source = self.source
+        token_buffer = JackTokenizer(source).tokenize_to_buffer()
+        root = build_ast(token_buffer)
+        segments = []
+        if root is not None:
+            ranges, class_end = self._subroutine_ranges(token_buffer, 0, len(token_buffer), 0)
+            subroutine_nodes = [node for node in root.children if node.kind == 'subroutineDec']
+            header_nodes = root.children[:root.children.index(subroutine_nodes[0])] if subroutine_nodes \
+                else root.children[:-1]
+            bounds = [0] + [first for first, _ in ranges] + [class_end]
+            nodes = [header_nodes] + [[node] for node in subroutine_nodes] + [root.children[-1:]]
+            for i, segment_nodes in enumerate(nodes):
+                first = bounds[i]
+                stop = bounds[i + 1] if i + 1 < len(bounds) else len(token_buffer)
+                segment_start = token_buffer.starts[first] if i else 0
+                segment_end = token_buffer.starts[stop] if stop < len(token_buffer) and i + 1 < len(bounds) \
+                    else len(source)
+                line_number = token_buffer.line_numbers[first] if i else 1
+                tokens = self._slice_tokens(token_buffer, first, stop, source[segment_start:segment_end],
+                                            segment_start)
+                segments.append(_Segment(segment_start, segment_end, line_number, tokens, segment_nodes))
+        self.root = root
+        self._segments = segments
+
+    def _reparse_subroutines(self, old_source, start, end, length):
+        """parse again the subroutine segments holding source[start:end] of old_source, now replaced by length
+        characters
+        Returns:
+            bool: False if the edit is not confined to subroutines that can be parsed on their own
+        """
+        segments = self._segments
+        if len(segments) < 3:  # no subroutines
+            return False
+        starts = [segment.start for segment in segments]
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_right(starts, max(start, end - 1)) - 1
+        if first < 1 or last > len(segments) - 2:  # the header or the closing brace is edited
+            return False
+        region_start = segments[first].start
+        old_region_end = segments[last].end
+        delta = length - (end - start)
+        region = self.source[region_start:old_region_end + delta]
+        if not self._ends_cleanly(region):
+            return False
+
+        tokenizer = JackTokenizer(region)
+        tokenizer.line_number = segments[first].line_number
+        tokenizer.column = segments[first].tokens.columns[0]
+        try:
+            token_buffer = tokenizer.tokenize_to_buffer()
+        except ParseException:
+            return False
+        ranges, _ = self._subroutine_ranges(token_buffer, 0, len(token_buffer), 1)
+        if not ranges or ranges[0][0] != 0 or ranges[-1][1] != len(token_buffer) or \
+                sum(stop - first_token for first_token, stop in ranges) != len(token_buffer):
+            return False
+        new_segments = []
+        for i, (first_token, stop) in enumerate(ranges):
+            node = self._parse_subroutine(token_buffer, first_token, stop)
+            if node is None:
+                return False
+            segment_start = token_buffer.starts[first_token] if i else 0
+            segment_end = token_buffer.starts[ranges[i + 1][0]] if i + 1 < len(ranges) else len(region)
+            line_number = token_buffer.line_numbers[first_token] if i else segments[first].line_number
+            tokens = self._slice_tokens(token_buffer, first_token, stop, region[segment_start:segment_end],
+                                        segment_start)
+            new_segments.append(_Segment(region_start + segment_start, region_start + segment_end, line_number,
+                                         tokens, [node]))
+
+        following = segments[last + 1]
+        if tokenizer.column != following.tokens.columns[0]:  # the edit moved the tokens after it along their line
+            return False
+        line_delta = tokenizer.line_number - following.line_number
+        for segment in segments[last + 1:]:
+            segment.start += delta
+            segment.end += delta
+            segment.line_number += line_delta
+            segment.line_offset += line_delta
+        segments[first:last + 1] = new_segments
+        self.root.children = [node for segment in segments for node in segment.nodes]
+        return True
+
+    def _subroutine_ranges(self, token_buffer, start, stop, depth):
+        """find the subroutines among token_buffer[start:stop] by their braces
+        Args:
+            depth (int): brace depth at start, subroutines start at depth 1
+        Returns:
+            tuple: list of (first, stop) token index ranges of the subroutines, and the index of the brace
+                closing the class, None if it is not among the tokens
+        """
+        ranges = []
+        first = None
+        for i in range(start, stop):
+            value = token_buffer.value(i)
+            if value == LEFT_BRACE:
+                depth += 1
+            elif value == RIGHT_BRACE:
+                depth -= 1
+                if depth == 1 and first is not None:
+                    ranges.append((first, i + 1))
+                    first = None
+                elif depth == 0:
+                    return ranges, i
+            elif depth == 1 and first is None and value in self.SUBROUTINE_KEYWORDS and \
+                    token_buffer.type(i) == KEYWORD:
+                first = i
+        return ranges, None
+
+    @staticmethod
+    def _parse_subroutine(token_buffer, start, stop):
+        """parse token_buffer[start:stop] as one subroutineDec, None if it is not exactly one"""
+        compilation_engine = BufferedCompilationEngine(token_buffer, None, AstBuilder(None), start, stop)
+        compilation_engine.emitter.line_number = compilation_engine.current_line_number
+        compilation_engine._advance()
+        try:
+            compilation_engine.compile_subroutine_dec()
+        except ParseException:
+            return None
+        if compilation_engine.index != stop - 1:
+            return None
+        return compilation_engine.emitter.root
+
+    @staticmethod
+    def _ends_cleanly(region):
+        """whether tokenizing the source continues at the end of region as if region were tokenized on its own,
+        that is region does not end in an unterminated comment or string constant, nor with a token or line
+        comment that would run into the following text
+        """
+        last = None
+        for m in JackTokenizer.jack_token.finditer(region):
+            last = m
+            if m.lastgroup == OPEN_COMMENT or m.group() == DOUBLE_QUOTES and JackTokenizer._is_cut(
+                    region, m.start(), len(region)):
+                return False
+        if last is None or last.lastgroup in ('space', 'newline'):
+            return True
+        if last.lastgroup == 'comment':
+            return last.group().startswith('/*')
+        return last.lastgroup == SYMBOL and last.group() != '/'
+
+    @staticmethod
+    def _slice_tokens(token_buffer, start, stop, text, offset):
+        """token_buffer[start:stop] as a TokenBuffer of text, which starts at offset in the source of
+        token_buffer
+        """
+        tokens = TokenBuffer(text)
+        tokens.type_codes = token_buffer.type_codes[start:stop]
+        tokens.starts = array('q', map((-offset).__add__, token_buffer.starts[start:stop]))
+        tokens.ends = array('q', map((-offset).__add__, token_buffer.ends[start:stop]))
+        tokens.line_numbers = token_buffer.line_numbers[start:stop]
+        tokens.columns = token_buffer.columns[start:stop]
+        return tokens
+
+    @staticmethod
+    def _shift_lines(segment):
+        offset = segment.line_offset
+        segment.tokens.line_numbers = array('q', map(offset.__add__, segment.tokens.line_numbers))
+        pending = list(segment.nodes)
+        while pending:
+            node = pending.pop()
+            node.line_number += offset
+            if isinstance(node, Node):
+                pending.extend(node.children)
+        segment.line_offset = 0
+
+
+def atomic_open(path, mode='w', compress=None):
+    """open a temporary file next to path which is renamed into place only if the with-block succeeds,
+    so readers never see a half-written output file. A file with the same content as the existing one is
+    dropped instead, leaving the existing file and its modification time alone. Missing directories of path
+    are created
+    Args:
+        path (str): final path of the file
+        mode (str): mode the temporary file is opened with
+        compress (str): one of COMPRESSIONS to compress what is written as it is written, None to write it as is
+    """
+    return _AtomicFile(path, mode, compress)
+
+
+class _AtomicFile:
+    def __init__(self, path, mode, compress=None):
+        self.path = path
+        self.mode = mode
+        self.compress = compress
+        self.file = self.stream = None
+
+    def __enter__(self):
+        directory, name = os.path.split(self.path)
+        # unique per process and per writer, and in the same directory so os.replace is atomic
+        self.tmp_path = os.path.join(directory, f'.{name}.{os.getpid()}.{id(self):x}.tmp')
+        mode = 'wb' if self.compress else self.mode
+        try:
+            self.file = open(self.tmp_path, mode)
+        except FileNotFoundError:
+            os.makedirs(directory, exist_ok=True)
+            self.file = open(self.tmp_path, mode)
+        self.stream = compressing_stream(self.file, self.compress, 'b' in self.mode) if self.compress \
+            else self.file
+        return self.stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()  # writes the end of the compressed data
+        self.file.close()
+        if exc_type is None and not _same_content(self.tmp_path, self.path):
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.unlink(self.tmp_path)
+        return False
+
+
+def compressing_stream(out_stream, compress, binary=False):
+    """stream compressing what is written to it into out_stream as it goes, closing it leaves out_stream open
+    Args:
+        out_stream (stream): binary file to write the compressed data to
+        compress (str): one of COMPRESSIONS
+        binary (bool): whether the stream takes bytes, or str encoded like a file opened in text mode
+    """
+    # imported only when compressing, like the other modules that most runs do not use, to keep start up fast
+    if compress == 'gzip':
+        import gzip
+        # neither file name nor time in the header, so the same output always compresses to the same bytes
+        stream = gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=out_stream, mtime=0)
+    elif compress == 'bz2':
+        import bz2
+        stream = bz2.BZ2File(out_stream, 'wb')
+    elif compress == 'xz':
+        import lzma
+        stream = lzma.LZMAFile(out_stream, 'wb', preset=2)  # the default preset takes ~100MB and is 20x slower
+    else:
+        raise ValueError(f'unknown compression: {compress!r}, expected one of {", ".join(COMPRESSIONS)}')
+    return stream if binary else io.TextIOWrapper(stream)
+
+
+def _same_content(path, other_path):
+    """whether the files have the same bytes, False if other_path does not exist"""
+    try:
+        if os.path.getsize(path) != os.path.getsize(other_path):
+            return False
+        with open(path, 'rb') as f, open(other_path, 'rb') as other:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                if chunk != other.read(len(chunk)):
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def analyzer_fingerprint():
+    """hash of this module's source, so cached outputs of an older analyzer are never reused"""
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def file_digest(path):
+    """sha256 hex digest of the file content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """persistent store of generated xml keyed on source content hash and analyzer fingerprint
+    entries are evicted oldest-used first once older than max_age_seconds or beyond max_bytes in total
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_age_seconds=CACHE_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._evicted_at = None  # time.monotonic() of the last evict_if_due that evicted
+
+    def content_key(self, data, variant=''):
+        """key of the output of a source, read into memory once so the output is compiled from the same content
+        Args:
+            data (bytes): content of the source file
+            variant (str): kind of output, as returned by _output_variant
+        """
+        return self._key(hashlib.sha256(data).hexdigest(), variant)
 
-        if self.current_token_type == INT_CONSTANT:
-            self._write_tag_value('integerConstant', self.current_token_value)
-            self._eat(INT_CONSTANT)
-        elif self.current_token_type == STR_CONSTANT:
-            self._write_tag_value('stringConstant', self.current_token_value.strip(DOUBLE_QUOTES))
-            self._eat(STR_CONSTANT)
-        elif self.current_token_value in KEYWORD_CONSTANT:
-            self._write_tag_value(KEYWORD, self.current_token_value)
-            self._eat(self.current_token_value)
-        elif self.current_token_value in UNARY_OP:
-            self._write_tag_value(SYMBOL, self.current_token_value)
-            self._eat(self.current_token_value)
-            self.compile_term()
-        elif self.current_token_value == LEFT_PAREN:  # '(' expression ')'
-            self._handle_expr_or_expr_list_within_paren(self.compile_expression)
-        else:  # identifier
-            current_token_value = self.current_token_value
-            self._eat(IDENTIFIER)
-            next_token_value = self.current_token_value
-
-            # varName'[' expression ']'
-            if next_token_value == LEFT_BRACKET:
-                self._write_tag_value(IDENTIFIER, current_token_value)
-                self._write_tag_value(SYMBOL, LEFT_BRACKET)
-                self._eat(LEFT_BRACKET)
-                self.compile_expression()
-                self._write_tag_value(SYMBOL, RIGHT_BRACKET)
-                self._eat(RIGHT_BRACKET)
-            # subroutineCall: foo.bar(expressionList) | Foo.bar(expressionList)
-            elif next_token_value == DOT:
-                self._write_tag_value(IDENTIFIER, current_token_value)
-                self._write_tag_value(SYMBOL, DOT)
-                self._eat(DOT)
-                self._write_tag_value(IDENTIFIER, self.current_token_value)
-                self._eat(IDENTIFIER)
-                self._handle_expr_or_expr_list_within_paren(self.compile_expression_list)
-            # subroutineCall: bar(expressionList)
-            elif next_token_value == LEFT_PAREN:
-                self._write_tag_value(IDENTIFIER, current_token_value)
-                self._handle_expr_or_expr_list_within_paren(self.compile_expression_list)
-            # foo
-            else:
-                self._write_tag_value(IDENTIFIER, current_token_value)
+    @staticmethod
+    def _key(digest, variant=''):
+        variant = f':{variant}' if variant else ''
+        return hashlib.sha256(f'{analyzer_fingerprint()}:{digest}{variant}'.encode()).hexdigest()
 
-        # </term>
-        self.deindent()
-        self._write_close_tag('term')
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.xml')
 
-    def compile_expression_list(self):
+    def restore(self, key, out_file_path):
+        """copy the cached output for key to out_file_path
+        Returns:
+            bool: False if there is no entry for key
         """
-        compile jack expression list
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry, atomic_open(out_file_path, 'wb') as out_stream:
+                shutil.copyfileobj(entry, out_stream)
+        except FileNotFoundError:
+            return False
+        os.utime(entry_path)  # mark as recently used for eviction
+        return True
+
+    def store(self, key, out_file_path):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        with open(out_file_path, 'rb') as out_stream, atomic_open(entry_path, 'wb') as entry:
+            shutil.copyfileobj(out_stream, entry)
+
+    def _entries(self):
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.xml'):
+                        yield entry
+
+    def evict(self):
+        """remove expired entries, then least recently used ones until the cache fits in max_bytes"""
+        expiry = time.time() - self.max_age_seconds
+        entries = []
+        for entry in self._entries():
+            stat = entry.stat()
+            if stat.st_mtime < expiry:
+                _remove_quietly(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove_quietly(path)
+            total -= size
+
+    def evict_if_due(self):
+        """evict, unless already done in the last CACHE_EVICT_INTERVAL_SECONDS, so a long running watcher scans
+        the cache once at start up and then on a timer rather than after every build
         """
-        # <expressionList>
-        self._write_open_tag('expressionList')
-        self.reindent()
+        now = time.monotonic()
+        if self._evicted_at is None or now - self._evicted_at >= CACHE_EVICT_INTERVAL_SECONDS:
+            self.evict()
+            self._evicted_at = now
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _remove_quietly(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:  # removed concurrently by another run
+        pass
+
+
+class FileStats:
+    """where the time of compiling one file went, in seconds, and how much was compiled
+    read is file input, tokenize the tokenizer without its reads, write the output file writes, and parse
+    the rest of the compilation engine
+    """
+    __slots__ = ('read', 'tokenize', 'parse', 'write', 'total', 'tokens', 'productions')
+    PHASES = ('read', 'tokenize', 'parse', 'write', 'total')
+
+    def __init__(self):
+        self.read = self.tokenize = self.parse = self.write = self.total = 0.0
+        self.tokens = 0
+        self.productions = collections.Counter()  # open tags, one per compile_* call
+
+    def as_dict(self):
+        return {**{phase: round(getattr(self, phase), 6) for phase in self.PHASES},
+                'tokens': self.tokens, 'productions': dict(self.productions)}
+
+
+class _TimedReader:
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.stats.read += time.perf_counter() - start
+        return data
+
+
+class _TimedWriter:
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.stream.write(data)
+        self.stats.write += time.perf_counter() - start
+
+
+class CountingEmitter:
+    """emitter counting the productions written through it to another emitter"""
+
+    def __init__(self, emitter, productions):
+        self.emitter = emitter
+        self.productions = productions
+        self.tag_value = emitter.tag_value
+        self.close_tag = emitter.close_tag
+        self.flush = emitter.flush
+
+    def open_tag(self, tag, level):
+        self.productions[tag] += 1
+        self.emitter.open_tag(tag, level)
+
+
+class IndexingEmitter:
+    """emitter collecting the symbols of the class written through it to another emitter
+    symbols is json serializable:
+        {'name': class name, 'line_number': ...,
+         'variables': {name: [static | field, type, line_number]},
+         'subroutines': {name: [constructor | function | method, return type, [[type, name], ...], line_number]},
+         'calls': [[class, subroutine, calling subroutine, line_number, column, number of arguments], ...]}
+    the class of a call is the type of its receiver if that is a variable in scope, the receiver itself otherwise
+    and the class being compiled for calls without one
+    """
+
+    def __init__(self, emitter, line_number=None, column=None):
+        """
+        Args:
+            emitter (XmlEmitter): what the parse tree is written with
+            line_number (Callable): returns the line number of the current token, like
+                CompilationEngine.current_line_number
+            column (Callable): returns the column of the current token, like CompilationEngine.current_column
+        """
+        self.emitter = emitter
+        self.line_number = line_number
+        self.column = column
+        self.flush = emitter.flush
+        self.symbols = None
+        # kind, and the (tag, value, line_number, column) of the tokens directly in it, of the open tag at every
+        # level, tags left open by the error recovering mode are dropped when a tag at their level is written
+        self._open = []
+        self._subroutine = None
+        self._locals = {}  # name: type of the parameters and local variables of the current subroutine
+        self._calls = []  # (level of its expressionList, entry in symbols['calls']) of the calls being compiled
+
+    def open_tag(self, tag, level):
+        del self._open[level:]
+        if tag == 'expression' and self._calls and self._calls[-1][0] == level - 1:
+            self._calls[-1][1][5] += 1  # an argument
+        self._open.append((tag, []))
+        self.emitter.open_tag(tag, level)
+
+    def tag_value(self, tag, value, level):
+        kind, tokens = self._open[level - 1]
+        if value == LEFT_PAREN and tag == SYMBOL and kind in ('term', 'doStatement') and tokens \
+                and tokens[-1][0] == IDENTIFIER:
+            self._call(tokens, level)
+        elif kind == CLASS and len(tokens) == 1:
+            self.symbols = self._class_symbols(value, tokens[0][2])
+        tokens.append((tag, value, self.line_number(), self.column()))
+        self.emitter.tag_value(tag, value, level)
+
+    def close_tag(self, tag, level):
+        _, tokens = self._open[level]
+        del self._open[level:]
+        if tag == 'classVarDec':
+            for _, name, _, _ in tokens[2::2]:
+                self.symbols['variables'][name] = [tokens[0][1], tokens[1][1], tokens[0][2]]
+        elif tag == 'varDec':
+            for _, name, _, _ in tokens[2::2]:
+                self._locals[name] = tokens[1][1]
+        elif tag == 'expressionList':
+            while self._calls and self._calls[-1][0] >= level:
+                self._calls.pop()
+        elif tag == 'parameterList':
+            # the subroutineDec tokens so far are its kind, return type, name and (
+            kind, return_type, (_, self._subroutine, line_number, _) = self._open[-1][1][:3]
+            parameters = [[tokens[i][1], tokens[i + 1][1]] for i in range(0, len(tokens), 3)]
+            self._locals = {name: parameter_type for parameter_type, name in parameters}
+            self.symbols['subroutines'][self._subroutine] = [kind[1], return_type[1], parameters, line_number]
+        elif tag == 'subroutineDec':
+            self._subroutine = None
+            self._locals = {}
+        self.emitter.close_tag(tag, level)
+
+    def _class_symbols(self, name, line_number):
+        return {'name': name, 'line_number': line_number, 'variables': {}, 'subroutines': {}, 'calls': []}
+
+    def _call(self, tokens, level):
+        """record the call whose subroutine name is the last of tokens, its arguments are counted as its
+        expressionList at level is compiled
+        """
+        _, name, line_number, column = tokens[-1]
+        if len(tokens) >= 3 and tokens[-2][1] == DOT:
+            receiver = tokens[-3][1]
+            class_name = self._locals.get(receiver) or \
+                (self.symbols['variables'].get(receiver) or (None, receiver))[1]
+            line_number, column = tokens[-3][2:]
+        else:
+            class_name = self.symbols['name']
+        call = [class_name, name, self._subroutine, line_number, column, 0]
+        self.symbols['calls'].append(call)
+        self._calls.append((level, call))
+
+
+class CheckingEmitter(IndexingEmitter):
+    """IndexingEmitter also resolving the variables used in terms and let statements against the scopes of the
+    subroutine and the class, those declared in neither are added to symbols as
+        'undeclared': [[name, line_number, column], ...]
+    calls are resolved once the symbols of every class are known, by check_calls
+    """
+
+    def tag_value(self, tag, value, level):
+        kind, tokens = self._open[level - 1]
+        if kind == 'letStatement' and len(tokens) == 1:
+            self._resolve(value, self.line_number(), self.column())
+        elif kind == 'term' and value == LEFT_BRACKET and len(tokens) == 1 and tokens[0][0] == IDENTIFIER:
+            self._resolve(*tokens[0][1:])
+        super().tag_value(tag, value, level)
+
+    def close_tag(self, tag, level):
+        if tag == 'term':
+            tokens = self._open[level][1]
+            if len(tokens) == 1 and tokens[0][0] == IDENTIFIER:  # neither a call nor an array entry
+                self._resolve(*tokens[0][1:])
+        super().close_tag(tag, level)
+
+    def _class_symbols(self, name, line_number):
+        return {**super()._class_symbols(name, line_number), 'undeclared': []}
+
+    def _resolve(self, name, line_number, column):
+        if name not in self._locals and name not in self.symbols['variables']:
+            self.symbols['undeclared'].append([name, line_number, column])
+
+
+def check_calls(results, known_symbols=()):
+    """second pass of CompileOptions.check, once every source is parsed: resolve the calls of every class against
+    the subroutines declared by all of them, calls to other classes, like those of the jack OS, are not checked
+    it is a dict lookup per call, so it runs in this process even when the sources were parsed in a pool, sending
+    the signatures of every class to the workers would cost more than the check
+    Args:
+        results (list): FileResult or SourceResult of every source
+        known_symbols (Iterable): IndexingEmitter.symbols of classes compiled earlier, calls to them are checked
+            too but they are not, a class of results replaces the known one of the same name
+    Returns:
+        list: results, with those of classes that have undeclared variables or wrong calls replaced by failed ones
+            holding a Diagnostic of each
+    """
+    signatures = {}  # class name: {subroutine name: number of parameters}
+    checked = [i for i, result in enumerate(results) if result.symbols is not None]
+    for symbols in chain(known_symbols, (results[i].symbols for i in checked)):
+        signatures[symbols['name']] = {name: len(parameters)
+                                       for name, (_, _, parameters, _) in symbols['subroutines'].items()}
+    results = list(results)
+    for i in checked:
+        diagnostics = _check_symbols(results[i].symbols, signatures)
+        if diagnostics:
+            results[i] = results[i]._replace(
+                error=f'{len(diagnostics)} semantic error{"s" if len(diagnostics) > 1 else ""}',
+                diagnostics=tuple(diagnostics))
+    return results
+
+
+def _check_symbols(symbols, signatures):
+    """
+    Returns:
+        list: Diagnostic of the undeclared variables and wrong calls of the class of symbols, in source order
+    """
+    diagnostics = [Diagnostic(line_number, f'undeclared variable: {name}', column)
+                   for name, line_number, column in symbols.get('undeclared', ())]
+    for class_name, name, _, line_number, column, arguments in symbols['calls']:
+        subroutines = signatures.get(class_name)
+        if subroutines is None:
+            continue
+        parameters = subroutines.get(name)
+        if parameters is None:
+            diagnostics.append(Diagnostic(line_number, f'undeclared subroutine: {class_name}.{name}', column))
+        elif parameters != arguments:
+            diagnostics.append(Diagnostic(
+                line_number, f'{class_name}.{name} takes {parameters} argument{"s" if parameters != 1 else ""}, '
+                             f'called with {arguments}', column))
+    return sorted(diagnostics, key=attrgetter('line_number', 'column'))
+
+
+class SymbolIndex:
+    """classes, their variables and subroutines, and the call sites of every subroutine across source files
+    collected by IndexingEmitter, saved as compact json with the callers already grouped so loading is a single
+    json.load
+    """
+    VERSION = 2
+
+    def __init__(self):
+        self.classes = {}  # class name: IndexingEmitter.symbols with the 'path' of its source
+        self.callers = {}  # 'Class.subroutine': [[path, calling class, calling subroutine, line_number], ...]
+
+    def add(self, path, symbols):
+        """add the symbols of a class compiled from path, replacing an earlier class of the same name"""
+        if symbols['name'] in self.classes:
+            self.remove(symbols['name'])
+        self.classes[symbols['name']] = {'path': path, **symbols}
+        for class_name, name, caller, line_number, _, _ in symbols['calls']:
+            self.callers.setdefault(f'{class_name}.{name}', []).append([path, symbols['name'], caller, line_number])
+
+    def remove(self, class_name):
+        path = self.classes.pop(class_name)['path']
+        for qualified_name, callers in list(self.callers.items()):
+            callers[:] = [caller for caller in callers if caller[0] != path or caller[1] != class_name]
+            if not callers:
+                del self.callers[qualified_name]
+
+    def subroutine(self, class_name, name):
+        """
+        Returns:
+            list: [kind, return type, [[type, name], ...], line_number], None if there is no such subroutine
+        """
+        symbols = self.classes.get(class_name)
+        return symbols and symbols['subroutines'].get(name)
 
-        # (expression (',' expression)*)?
-        if not self.current_token_value == RIGHT_PAREN:
-            while True:
-                self.compile_expression()
-                if not self.current_token_value == COMMA:
-                    break
-                self._write_tag_value(SYMBOL, COMMA)
-                self._eat(COMMA)
+    def calls_to(self, class_name, name):
+        return self.callers.get(f'{class_name}.{name}', [])
 
-        # </expressionList>
-        self.deindent()
-        self._write_close_tag('expressionList')
+    def unused_subroutines(self):
+        """'Class.subroutine' of the subroutines never called from the indexed classes, but Main.main"""
+        return [f'{class_name}.{name}' for class_name, symbols in self.classes.items()
+                for name in symbols['subroutines']
+                if f'{class_name}.{name}' not in self.callers and (class_name, name) != ('Main', 'main')]
 
+    def save(self, path):
+        with atomic_open(path) as f:
+            json.dump({'version': self.VERSION, 'classes': self.classes, 'callers': self.callers}, f,
+                      separators=(',', ':'))
 
-def handle_file(path):
+    @classmethod
+    def load(cls, path):
+        """
+        Raises:
+            ValueError: if path does not hold a symbol index of this version
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION:
+            raise ValueError(f'{path} is not a symbol index of version {cls.VERSION}')
+        index = cls()
+        index.classes = data['classes']
+        index.callers = data['callers']
+        return index
+
+    @classmethod
+    def from_results(cls, results):
+        """index of the symbols of FileResults compiled with CompileOptions.index"""
+        index = cls()
+        for result in results:
+            if result.symbols is not None:
+                index.add(result.path, result.symbols)
+        return index
+
+
+def _timed_tokens(tokens, stats):
+    clock = time.perf_counter
+    while True:
+        start = clock()
+        try:
+            token = next(tokens)
+        except StopIteration:
+            stats.tokenize += clock() - start
+            return
+        stats.tokenize += clock() - start
+        stats.tokens += 1
+        yield token
+
+
+class FileResult(NamedTuple):
+    path: str
+    error: Optional[str] = None  # None if the file compiled successfully
+    cached: bool = False
+    stats: Optional[FileStats] = None
+    diagnostics: tuple = ()  # every error of the file when compiled with CompileOptions.recover
+    symbols: Optional[dict] = None  # IndexingEmitter.symbols of the class when compiled with CompileOptions.index
+    # or CompileOptions.check
+
+
+class CompileOptions(NamedTuple):
+    cache: Optional[BuildCache] = None  # None to always recompile
+    token_buffer: bool = False  # tokenize the whole file into a TokenBuffer before parsing
+    stats: bool = False  # collect FileStats, costs a clock reading per token, only the total time if binary
+    recover: bool = False  # report every error of a file rather than stopping at the first one
+    index: bool = False  # collect the symbols of every class, the cache is then only filled, never read
+    binary: bool = False  # write the format of dump_binary to BINARY_OUT_FILE_EXT files instead of xml
+    out_dir: Optional[str] = None  # outputs go here mirroring the sources under source_roots, None for next to them
+    source_roots: tuple = ()  # directories whose layout is mirrored in out_dir
+    tokens: Optional[str] = None  # xml or jsonl to write only the tokens with write_tokens, without parsing
+    check: bool = False  # resolve variables with CheckingEmitter and calls with check_calls, the cache is then only
+    # filled like with index
+    flush_lines: int = EMITTER_FLUSH_LINES  # xml lines held before they are written, bounds the output in memory
+    compress: Optional[str] = None  # one of COMPRESSIONS to write outputs compressed as they are produced
+
+
+def _compile_file(path, options=CompileOptions()):
+    """compile path into its xml file, reusing the cached output if the source did not change
+    Returns:
+        FileResult: of the compiled file
+    """
+    stats = FileStats() if options.stats else None
+    start = time.perf_counter()
+    out_file_path = _out_file_path(path, options)
+    cache = options.cache
+    if cache:
+        # the key is hashed from the very bytes that are compiled, so a save while compiling cannot have the
+        # output of the new content cached for the old one
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = cache.content_key(data, _output_variant(options))
+        if not _collects_symbols(options) and cache.restore(key, out_file_path):
+            if stats:
+                stats.total = time.perf_counter() - start
+            return FileResult(path, cached=True, stats=stats)
+        in_stream = io.TextIOWrapper(io.BytesIO(data))  # decoded like open(path) in text mode would
+    else:
+        in_stream = open(path)
+    diagnostics = [] if options.recover else None
+    with in_stream as inFileStream:
+        # an error leaves no output file, the half-written one is removed by atomic_open
+        with atomic_open(out_file_path, 'wb' if options.binary else 'w', options.compress) as outFileStream:
+            if stats and not (options.binary or options.tokens):
+                symbols = _compile_stream_with_stats(inFileStream, outFileStream, options, stats, diagnostics)
+            else:
+                symbols = _compile_stream(inFileStream, outFileStream, options, diagnostics)
+    if cache:
+        cache.store(key, out_file_path)
+    if stats:
+        stats.total = time.perf_counter() - start
+        stats.parse = stats.total - stats.read - stats.tokenize - stats.write
+    return FileResult(path, stats=stats, symbols=symbols)
+
+
+def _out_file_path(path, options=CompileOptions()):
+    """path of the output file of the source at path, next to it or at the same place under options.out_dir as
+    the source is under the deepest of options.source_roots holding it, directly in options.out_dir if none does
+    """
+    if options.tokens:
+        out_file_ext = TOKEN_OUT_FILE_EXTS[options.tokens]
+    else:
+        out_file_ext = BINARY_OUT_FILE_EXT if options.binary else OUT_FILE_EXT
+    if options.compress:
+        out_file_ext += COMPRESSIONS[options.compress]
+    if options.out_dir is not None:
+        path = os.path.join(options.out_dir, _relative_source_path(path, options.source_roots))
+    return _replace_ext(path, IN_FILE_EXT, out_file_ext)
+
+
+def _relative_source_path(path, roots):
+    path = os.path.abspath(path)
+    root = max((root for root in map(os.path.abspath, roots)
+                if os.path.commonpath([root, path]) == root and root != path), key=len, default=None)
+    return os.path.basename(path) if root is None else os.path.relpath(path, root)
+
+
+def _replace_ext(path, ext, new_ext):
+    """path with its ext suffix replaced by new_ext, or new_ext appended if it does not end with ext"""
+    return (path[:-len(ext)] if path.endswith(ext) else path) + new_ext
+
+
+def _output_variant(options):
+    """what tells apart the outputs of the same source compiled with options in the cache"""
+    if options.tokens:
+        variant = f'tokens-{options.tokens}'
+    else:
+        variant = 'binary' if options.binary else ''
+    return f'{variant}:{options.compress}' if options.compress else variant
+
+
+def _compile_stream(in_stream, out_stream, options=CompileOptions(), diagnostics=None):
+    """compile the jack class read from in_stream into xml written to out_stream, into the format of
+    dump_binary if options.binary, out_stream is then binary, or only tokenize it if options.tokens. Xml is
+    written out every options.flush_lines lines
+    Returns:
+        dict: IndexingEmitter.symbols of the class if options.index or options.check, None otherwise
+    Raises:
+        ParseErrors: if errors were appended to diagnostics
+    """
+    tokenizer = JackTokenizer(in_stream, diagnostics=diagnostics)
+    if options.tokens:
+        write_tokens(tokenizer.start_tokenizer(), out_stream, options.tokens, options.flush_lines)
+        _raise_diagnostics(diagnostics)
+        return None
+    if options.binary:
+        return _compile_binary(tokenizer, out_stream, options, diagnostics)
+    emitter = _symbols_emitter(XmlEmitter(out_stream, options.flush_lines), options)
+    if options.token_buffer:
+        compilation_engine = BufferedCompilationEngine(tokenizer.tokenize_to_buffer(), out_stream, emitter,
+                                                       diagnostics=diagnostics)
+    else:
+        compilation_engine = CompilationEngine(tokenizer.start_tokenizer(), out_stream, emitter, diagnostics)
+    return _run_engine(compilation_engine, diagnostics)
+
+
+def _collects_symbols(options):
+    return options.index or options.check
+
+
+def _symbols_emitter(emitter, options):
+    """emitter wrapped to collect the symbols options ask for, emitter itself if they ask for none"""
+    if options.check:
+        return CheckingEmitter(emitter)
+    return IndexingEmitter(emitter) if options.index else emitter
+
+
+def _run_engine(compilation_engine, diagnostics):
+    emitter = compilation_engine.emitter
+    if isinstance(emitter, IndexingEmitter):
+        emitter.line_number = compilation_engine.current_line_number
+        emitter.column = compilation_engine.current_column
+    compilation_engine.compile_class()
+    _raise_diagnostics(diagnostics)
+    return emitter.symbols if isinstance(emitter, IndexingEmitter) else None
+
+
+def _compile_binary(tokenizer, out_stream, options, diagnostics):
+    token_buffer = tokenizer.tokenize_to_buffer()
+    ast_builder = AstBuilder(None)
+    emitter = _symbols_emitter(ast_builder, options)
+    compilation_engine = BufferedCompilationEngine(token_buffer, None, emitter, diagnostics=diagnostics)
+    ast_builder.line_number = compilation_engine.current_line_number
+    symbols = _run_engine(compilation_engine, diagnostics)
+    dump_binary(token_buffer, ast_builder.root, out_stream)
+    return symbols
+
+
+def _raise_diagnostics(diagnostics):
+    if diagnostics:
+        # the tokenizer reads ahead of the parser, so its errors may have been appended early
+        raise ParseErrors(sorted(diagnostics, key=attrgetter('line_number', 'column')))
+
+
+def _compile_stream_with_stats(in_stream, out_stream, options, stats, diagnostics=None):
+    """same as the compilation in _compile_file, with every phase timed"""
+    tokenizer = JackTokenizer(_TimedReader(in_stream, stats), diagnostics=diagnostics)
+    out_stream = _TimedWriter(out_stream, stats)
+    emitter = _symbols_emitter(CountingEmitter(XmlEmitter(out_stream, options.flush_lines), stats.productions),
+                               options)
+    if options.token_buffer:
+        start = time.perf_counter()
+        token_buffer = tokenizer.tokenize_to_buffer()
+        stats.tokenize += time.perf_counter() - start
+        stats.tokens = len(token_buffer)
+        compilation_engine = BufferedCompilationEngine(token_buffer, out_stream, emitter, diagnostics=diagnostics)
+    else:
+        compilation_engine = CompilationEngine(
+            _timed_tokens(tokenizer.start_tokenizer(), stats), out_stream, emitter, diagnostics)
+    symbols = _run_engine(compilation_engine, diagnostics)
+    stats.tokenize -= stats.read  # the tokenizer reads its input while it is timed
+    return symbols
+
+
+def _compile_file_job(path, options=CompileOptions()):
+    """compile one file and report the outcome instead of raising, runs in worker processes"""
+    try:
+        return _compile_file(path, options)
+    except ParseErrors as e:
+        return FileResult(path, str(e), diagnostics=tuple(e.diagnostics))
+    except (ParseException, OSError, UnicodeDecodeError) as e:
+        return FileResult(path, str(e))
+
+
+def handle_file(path, options=CompileOptions()):
     logging.info(f'Parsing {path}')
-    out_file_path = path.replace(IN_FILE_EXT, OUT_FILE_EXT)
-    with open(path) as inFileStream:
-        with open(out_file_path, 'w') as outFileStream:
-            tokens_stream = JackTokenizer(inFileStream.read()).start_tokenizer()
-            compilation_engine = CompilationEngine(tokens_stream, outFileStream)
-            compilation_engine.compile_class()
+    _compile_file(path, options)
+
+
+def compile_files(paths, jobs=1, options=CompileOptions(), known_symbols=(), executor=None):
+    """compile the given jack files, in a pool of worker processes if jobs > 1
+    results are logged and returned in the order of paths whatever order the workers finish in. paths may be a
+    generator like discover_sources, files are then compiled while the rest are still being found
+    Args:
+        paths (Iterable): paths of jack source files
+        jobs (int): number of worker processes, 0 means one per cpu
+        options (CompileOptions): how to compile each file
+        known_symbols (Iterable): with options.check, symbols of other classes the calls are checked against, like
+            for check_calls
+        executor (Executor): pool of jobs workers to compile in, to share its started workers between builds, None
+            to start one for this build if jobs > 1
+    Returns:
+        list: FileResult for every path
+    """
+    jobs = jobs or os.cpu_count() or 1
+    results = []
+    if jobs == 1 or isinstance(paths, list) and len(paths) < 2:
+        for result in map(functools.partial(_compile_file_job, options=options), paths):
+            _log_result(result)
+            results.append(result)
+    else:
+        # batch small files together so per-task pickling does not dominate
+        if isinstance(paths, list):
+            chunk_size = max(1, min(64, len(paths) // (jobs * 4)))
+            jobs = min(jobs, len(paths))
+        else:  # not known how many, small chunks keep the first results coming
+            chunk_size = DISCOVERY_CHUNK_SIZE
+        paths = iter(paths)
+        chunks = iter(lambda: list(islice(paths, chunk_size)), [])
+        own_executor = executor is None
+        if own_executor:
+            executor = futures.ProcessPoolExecutor(jobs)
+        try:
+            for chunk_results in _map_in_order(executor, functools.partial(_compile_file_chunk, options=options),
+                                               chunks, 2 * jobs):
+                for result in chunk_results:
+                    _log_result(result)
+                    results.append(result)
+        finally:
+            if own_executor:
+                executor.shutdown()
+    if options.check:  # the classes of all the files are known only now
+        results = _check_results(results, known_symbols)
+    _finish_compile(results, options)
+    return results
+
+
+def _check_results(results, known_symbols=()):
+    """check_calls, logging the results that fail it"""
+    checked = check_calls(results, known_symbols)
+    for result, checked_result in zip(results, checked):
+        if checked_result is not result:
+            _log_result(checked_result)
+    return checked
+
+
+def _compile_file_chunk(paths, options=CompileOptions()):
+    return [_compile_file_job(path, options) for path in paths]
+
+
+def _finish_compile(results, options):
+    if options.cache:
+        options.cache.evict_if_due()
+
+    failed = sum(1 for result in results if result.error is not None)
+    cached = sum(1 for result in results if result.cached)
+    errors = sum(len(result.diagnostics) for result in results)
+    logging.info(f'{len(results)} files: {len(results) - failed} passed ({cached} cached), {failed} failed'
+                 + (f', {errors} errors' if options.recover or options.check else ''))
+
+
+async def compile_files_async(paths, jobs=1, options=CompileOptions(), queue_depth=ASYNC_QUEUE_DEPTH):
+    """compile the given jack files in a pipeline of reading, parsing and writing stages connected by bounded
+    queues, so the file io of some files overlaps the parsing of others
+    reads and writes run in a thread pool, parsing in a pool of jobs worker processes, or in one thread if
+    jobs is 1. A full queue blocks the stage feeding it, at most about 2 * queue_depth sources and outputs are
+    held in memory. Results are logged and returned in the order of paths, like compile_files
+    Args:
+        paths (Iterable): paths of jack source files, may be a generator like discover_sources
+        jobs (int): number of parsing worker processes, 0 means one per cpu
+        options (CompileOptions): how to compile each file, stats are not collected
+        queue_depth (int): capacity of the queues between the stages
+    Returns:
+        list: FileResult for every path
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    jobs = jobs or os.cpu_count() or 1
+    cache = options.cache
+    results = {}  # by the index of the path
+    pending = enumerate(paths)  # shared by the readers
+    read_queue = asyncio.Queue(queue_depth)
+    write_queue = asyncio.Queue(queue_depth)
+
+    async def read():
+        for i, path in pending:
+            try:
+                cached, key, source = await loop.run_in_executor(io_executor, _read_source, path, options, cache)
+            except (OSError, UnicodeDecodeError) as e:
+                results[i] = FileResult(path, str(e))
+                continue
+            if cached:
+                results[i] = FileResult(path, cached=True)
+            else:
+                await read_queue.put((i, path, key, source))
+
+    async def parse():
+        while True:
+            item = await read_queue.get()
+            if item is None:
+                return
+            i, path, key, source = item
+            xml, error, diagnostics, symbols = await loop.run_in_executor(
+                cpu_executor, _parse_source, source, options)
+            if error is None:
+                await write_queue.put((i, path, key, xml, symbols))
+            else:
+                results[i] = FileResult(path, error, diagnostics=diagnostics)
+
+    async def write():
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                return
+            i, path, key, xml, symbols = item
+            try:
+                await loop.run_in_executor(io_executor, _write_output, _out_file_path(path, options), key, xml,
+                                           cache)
+            except OSError as e:
+                results[i] = FileResult(path, str(e))
+            else:
+                results[i] = FileResult(path, symbols=symbols)
+
+    io_workers = (min(ASYNC_IO_WORKERS, len(paths)) or 1) if isinstance(paths, list) else ASYNC_IO_WORKERS
+    with futures.ThreadPoolExecutor(io_workers * 2) as io_executor, \
+            (futures.ProcessPoolExecutor(jobs) if jobs > 1 else futures.ThreadPoolExecutor(1)) as cpu_executor:
+        readers = [asyncio.ensure_future(read()) for _ in range(io_workers)]
+        parsers = [asyncio.ensure_future(parse()) for _ in range(jobs)]
+        writers = [asyncio.ensure_future(write()) for _ in range(io_workers)]
+        try:
+            await asyncio.gather(*readers)
+            for _ in parsers:
+                await read_queue.put(None)
+            await asyncio.gather(*parsers)
+            for _ in writers:
+                await write_queue.put(None)
+            await asyncio.gather(*writers)
+        finally:
+            for task in readers + parsers + writers:
+                task.cancel()
+
+        results = [results[i] for i in range(len(results))]
+        for result in results:
+            _log_result(result)
+        if options.check:
+            results = _check_results(results)
+    _finish_compile(results, options)
+    return results
+
+
+def _read_source(path, options=CompileOptions(), cache=None):
+    """read stage of compile_files_async, restores the cached output if there is one
+    Returns:
+        tuple: whether the output was restored from cache, the cache key, and the source unless restored
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = cache and cache.content_key(data, _output_variant(options))
+    if cache and not _collects_symbols(options) and cache.restore(key, _out_file_path(path, options)):
+        return True, key, None
+    # decoded like open(path) in text mode would
+    return False, key, io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def _parse_source(source, options=CompileOptions()):
+    """parse stage of compile_files_async and compile_sources, errors are returned rather than raised as it runs in
+    worker processes
+    Returns:
+        tuple: the xml, or bytes of the binary format if options.binary or of the compressed output if
+            options.compress, or None, the error or None, the Diagnostic of every error if options.recover, and
+            the symbols of the class if options.index or options.check
+    """
+    buffer = out_stream = io.BytesIO() if options.binary or options.compress else io.StringIO()
+    if options.compress:  # what is held until it is written is then only the compressed output
+        out_stream = compressing_stream(buffer, options.compress, options.binary)
+    try:
+        symbols = _compile_stream(source, out_stream, options, [] if options.recover else None)
+    except ParseErrors as e:
+        return None, str(e), tuple(e.diagnostics), None
+    except ParseException as e:
+        return None, str(e), (), None
+    if options.compress:
+        out_stream.close()
+    return buffer.getvalue(), None, (), symbols
+
+
+def _write_output(out_file_path, key, xml, cache=None):
+    with atomic_open(out_file_path, 'wb' if isinstance(xml, bytes) else 'w') as out_stream:
+        out_stream.write(xml)
+    if cache:
+        cache.store(key, out_file_path)
+
+
+class SourceResult(NamedTuple):
+    name: str
+    # bytes of the binary format if CompileOptions.binary or of the compressed output if CompileOptions.compress,
+    # None if it did not compile
+    xml: Optional[str] = None
+    error: Optional[str] = None
+    diagnostics: tuple = ()  # every error of the source when compiled with CompileOptions.recover
+    symbols: Optional[dict] = None  # IndexingEmitter.symbols of the class when compiled with CompileOptions.index
+    # or CompileOptions.check
+
+
+def _compile_source_chunk(chunk, options):
+    """compile (name, source) pairs into SourceResults, one task of iter_compile_sources"""
+    return [SourceResult(name, *_parse_source(source, options)) for name, source in chunk]
+
+
+def iter_compile_sources(sources, jobs=1, options=CompileOptions(), executor=None, chunk_size=BATCH_CHUNK_SIZE):
+    """compile jack sources held in memory into xml, without reading or writing any file
+    sources are consumed lazily, with jobs > 1 at most 2 * jobs chunks of them are being compiled at a time
+    Args:
+        sources (Iterable): (name, source) pairs, source is jack source code as str
+        jobs (int): number of worker processes, 0 means one per cpu, ignored if executor is given
+        options (CompileOptions): how to compile each source, cache and stats are not used, with check the calls
+            are left to check_calls, see compile_sources
+        executor (Executor): pool to compile in, to share its started workers between batches, None to start one
+            for this batch if jobs > 1
+        chunk_size (int): sources sent to a worker at a time
+    Yields:
+        SourceResult: of every source, in the order of sources
+    """
+    sources = iter(sources)
+    chunks = iter(lambda: list(islice(sources, chunk_size)), [])
+    jobs = jobs or os.cpu_count() or 1
+    if executor is None and jobs == 1:
+        for chunk in chunks:
+            yield from _compile_source_chunk(chunk, options)
+        return
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ProcessPoolExecutor(jobs)
+    try:
+        for results in _map_in_order(executor, functools.partial(_compile_source_chunk, options=options), chunks,
+                                     2 * jobs):
+            yield from results
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def _map_in_order(executor, function, items, window):
+    """like executor.map, but items are consumed lazily with at most window of them submitted and not yet
+    yielded, and results are yielded as soon as they and the ones before them are done
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            while pending and (len(pending) >= window or pending[0].done()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def compile_sources(sources, jobs=1, options=CompileOptions(), sink=None, executor=None):
+    """compile jack sources held in memory, like iter_compile_sources
+    Args:
+        sink (Callable): called with every SourceResult as soon as it is ready instead of collecting them, in the
+            order of sources, with options.check only once all of them are checked by check_calls
+    Returns:
+        list: SourceResult of every source, None if they were given to sink
+    """
+    if options.check:  # every source has to be parsed before any can be given to sink
+        results = check_calls(list(iter_compile_sources(sources, jobs, options, executor)))
+    else:
+        results = iter_compile_sources(sources, jobs, options, executor)
+    if sink is None:
+        return list(results)
+    for result in results:
+        sink(result)
+
+
+def _log_result(result):
+    if result.cached:
+        logging.info(f'Parsed {result.path} (cached)')
+    elif result.error is None:
+        logging.info(f'Parsed {result.path}')
+    else:
+        logging.error(f'Failed {result.path}: {result.error}')
+        for diagnostic in result.diagnostics:
+            logging.error(f'{result.path}:{diagnostic.line_number}:{diagnostic.column}: {diagnostic.message}')
+
+
+def stats_summary(results):
+    """per file and total FileStats of results compiled with CompileOptions.stats, json serializable"""
+    files = [{'path': result.path, 'cached': result.cached, **result.stats.as_dict()}
+             for result in results if result.stats is not None]
+    totals = {phase: round(sum(f[phase] for f in files), 6) for phase in FileStats.PHASES}
+    totals['tokens'] = sum(f['tokens'] for f in files)
+    productions = collections.Counter()
+    for result in results:
+        if result.stats is not None:
+            productions.update(result.stats.productions)
+    totals['productions'] = dict(productions.most_common())
+    return {'files': files, 'totals': totals}
+
+
+def print_stats(summary, out_stream=sys.stdout, slowest=10):
+    """print the totals of a stats_summary and its slowest files as tables"""
+    totals = summary['totals']
+    total = totals['total'] or 1.0
+    out_stream.write(f'{"phase":<10} {"seconds":>10} {"share":>7}{NEWLINE}')
+    for phase in FileStats.PHASES:
+        out_stream.write(f'{phase:<10} {totals[phase]:>10.4f} {totals[phase] / total:>7.1%}{NEWLINE}')
+    tokens_per_second = totals['tokens'] / totals['total'] if totals['total'] else 0
+    out_stream.write(f'{len(summary["files"])} files, {totals["tokens"]} tokens, '
+                     f'{tokens_per_second:,.0f} tokens/s{NEWLINE}{NEWLINE}')
+    out_stream.write(f'{"production":<16} {"count":>10}{NEWLINE}')
+    for production, count in totals['productions'].items():
+        out_stream.write(f'{production:<16} {count:>10}{NEWLINE}')
+    out_stream.write(f'{NEWLINE}{"slowest files":<50} {"seconds":>10} {"tokens":>9}{NEWLINE}')
+    for f in sorted(summary['files'], key=lambda f: f['total'], reverse=True)[:slowest]:
+        out_stream.write(f'{f["path"]:<50} {f["total"]:>10.4f} {f["tokens"]:>9}{NEWLINE}')
+
+
+def _dir_sources(path):
+    return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(IN_FILE_EXT)]
+
+
+def discover_sources(paths, recursive=False, include=(), exclude=()):
+    """find the jack source files of paths, yielding each as soon as it is found
+    directories are walked with os.scandir, depth first in name order, with the files of a directory before its
+    subdirectories. Symbolic links to directories are followed, but no directory is walked twice so link loops
+    end. Include and exclude glob patterns match the name of an entry or its path relative to the directory
+    given in paths, with / separators, like 'lib/*' or 'Test*.jack'
+    Args:
+        paths (Iterable): jack source files, always yielded, and directories
+        recursive (bool): also walk the subdirectories of directories
+        include (Iterable): patterns of which the source files of directories must match one, none for all
+        exclude (Iterable): patterns of files and subdirectories of directories to skip
+    Yields:
+        str: path of every source file
+    """
+    include = list(include)
+    exclude = list(exclude)
+    walked = set()  # (st_dev, st_ino) of the directories walked
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        pending = [(path, '')]  # directory, and its path relative to path with a trailing /
+        while pending:
+            directory, prefix = pending.pop()
+            try:
+                st = os.stat(directory)
+                if (st.st_dev, st.st_ino) in walked:
+                    continue
+                walked.add((st.st_dev, st.st_ino))
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=attrgetter('name'))
+            except OSError:  # removed since it was listed, or not readable
+                continue
+            subdirectories = []
+            for entry in entries:
+                relative_path = prefix + entry.name
+                if exclude and _matches_any(exclude, entry.name, relative_path):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    if recursive:
+                        subdirectories.append((entry.path, relative_path + '/'))
+                elif entry.name.endswith(IN_FILE_EXT) and \
+                        (not include or _matches_any(include, entry.name, relative_path)):
+                    yield entry.path
+            pending.extend(reversed(subdirectories))
+
+
+def _matches_any(patterns, name, relative_path):
+    return any(fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(relative_path, pattern)
+               for pattern in patterns)
+
+
+def handle_dir(path, jobs=1, options=CompileOptions()):
+    return compile_files(_dir_sources(path), jobs, options)
+
+
+class Watcher:
+    """polls jack source files and directories and compiles again the sources whose content changed"""
+
+    def __init__(self, paths, jobs=1, options=CompileOptions(), interval=WATCH_INTERVAL_SECONDS,
+                 debounce=WATCH_DEBOUNCE_SECONDS, discover=discover_sources, index_path=None):
+        """
+        Args:
+            paths (list): jack source files and directories, directories are listed again on every poll so new
+                sources are picked up
+            jobs (int): number of worker processes, as for compile_files
+            options (CompileOptions): how to compile each file
+            interval (float): seconds between polls
+            debounce (float): seconds a change must be followed by no other change before compiling, so a
+                save written in several steps is compiled once
+            discover (Callable): finds the sources of paths, like discover_sources
+            index_path (str): where to write the SymbolIndex of all the sources after every build, needs
+                options.index
+        """
+        self.paths = paths
+        self.discover = discover
+        self.jobs = jobs
+        self.options = options
+        self.interval = interval
+        self.debounce = debounce
+        self.index_path = index_path
+        self._sources = {}  # path: (mtime_ns, size, sha256 digest) when it was last seen
+        self._symbols = {}  # path: IndexingEmitter.symbols of the last build of the sources that compiled
+        self._executor = None  # started by the first build with more than one job, for all the following ones
+
+    def _source_paths(self):
+        return self.discover(self.paths)
+
+    def poll(self):
+        """find the sources that are new or whose content changed since the last poll
+        a file is only read again if its modification time or size changed
+        Returns:
+            list: paths of the changed sources
+        """
+        changed = []
+        sources = {}
+        for path in self._source_paths():
+            try:
+                st = os.stat(path)
+                seen = self._sources.get(path)
+                if seen is not None and seen[:2] == (st.st_mtime_ns, st.st_size):
+                    sources[path] = seen
+                    continue
+                digest = file_digest(path)
+            except OSError:  # removed since it was listed
+                continue
+            sources[path] = (st.st_mtime_ns, st.st_size, digest)
+            if seen is None or seen[2] != digest:
+                changed.append(path)
+        self._sources = sources  # removed sources are forgotten
+        return changed
+
+    def run(self, rounds=None):
+        """compile all sources, then keep compiling the changed ones until interrupted
+        Args:
+            rounds (int): number of polls before returning, None to poll until KeyboardInterrupt
+        Returns:
+            int: 0
+        """
+        try:
+            while rounds is None or rounds > 0:
+                changed = dict.fromkeys(self.poll())
+                while changed:  # debounce, wait for the writes to settle
+                    time.sleep(self.debounce)
+                    more = self.poll()
+                    if not more:
+                        break
+                    changed.update(dict.fromkeys(more))
+                removed = self._symbols.keys() - self._sources.keys()
+                if changed or removed:
+                    self.build(list(changed))
+                if rounds is not None:
+                    rounds -= 1
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        return 0
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def build(self, paths):
+        """compile the changed sources at paths, checking their calls against the classes of all the sources, and
+        write the index of all the sources if asked to
+        """
+        for path in self._symbols.keys() - self._sources.keys():  # removed since the last build
+            del self._symbols[path]
+        changed = set(paths)
+        known_symbols = [symbols for path, symbols in self._symbols.items() if path not in changed]
+        jobs = self.jobs or os.cpu_count() or 1
+        if self._executor is None and jobs > 1 and paths:
+            self._executor = futures.ProcessPoolExecutor(jobs)
+        results = compile_files(paths, jobs, self.options, known_symbols, self._executor) if paths else []
+        for result in results:
+            if result.symbols is None:
+                self._symbols.pop(result.path, None)
+            else:
+                self._symbols[result.path] = result.symbols
+        if self.index_path:
+            index = SymbolIndex()
+            for path, symbols in self._symbols.items():
+                index.add(path, symbols)
+            index.save(self.index_path)
+        return results
+
+
+SERVER_METHODS = ('tokenize', 'parse_xml', 'parse_ast')
+
+
+def analyze_source(method, source):
+    """run one of SERVER_METHODS on jack source code
+    Args:
+        method (str): tokenize, parse_xml or parse_ast
+        source (str): jack source code
+    Returns:
+        list | str | dict: [type, value, line_number, column] of every token, the xml parse tree, or the parse
+            tree as nested Node.to_dict, None for a source without tokens
+    Raises:
+        ParseException: if the source is not valid jack
+    """
+    tokenizer = JackTokenizer(source)
+    if method == 'tokenize':
+        return [list(token) for token in tokenizer.start_tokenizer()]
+    if method == 'parse_xml':
+        out_stream = io.StringIO()
+        CompilationEngine(tokenizer.start_tokenizer(), out_stream).compile_class()
+        return out_stream.getvalue()
+    if method == 'parse_ast':
+        root = build_ast(tokenizer.start_tokenizer())
+        return None if root is None else root.to_dict()
+    raise ValueError(f'unknown method: {method!r}, expected one of {", ".join(SERVER_METHODS)}')
+
+
+def serve_request(request):
+    """answer one request of the analyzer protocol, runs in the server or in process for a client without one
+    a request is {"id": ..., "method": one of SERVER_METHODS, "params": {"source": ...}}, sources
+    are sent rather than read by the server so clients cannot make it read their files, and it is answered with
+    {"id": ..., "result": ...} or {"id": ..., "error": {"type": exception class name, "message": ...}}
+    """
+    request_id = request.get('id') if isinstance(request, dict) else None
+    try:
+        params = request.get('params') or {}
+        result = analyze_source(request['method'], params['source'])
+    except (ParseException, RecursionError, LookupError, ValueError, TypeError, AttributeError) as e:
+        return _error_response(request_id, e)
+    return {'id': request_id, 'result': result}
+
+
+def _error_response(request_id, error):
+    return {'id': request_id, 'error': {'type': type(error).__name__, 'message': str(error)}}
+
+
+class AnalyzerServer:
+    """serves the analyzer protocol as json lines over a unix domain socket
+    each client connection is handled in its own thread and may send any number of requests, one json object per
+    line, each answered by one line. With more than one job requests are run in a pool of worker processes
+    """
+
+    def __init__(self, socket_path, jobs=1):
+        """
+        Args:
+            socket_path (str): path of the unix domain socket to listen on
+            jobs (int): number of worker processes, 1 to run requests in the server process, 0 for one per cpu
+        Raises:
+            OSError: if another server is already listening on socket_path
+        """
+        import socket
+        import socketserver
+        self.socket_path = socket_path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor = futures.ProcessPoolExecutor(self.jobs) if self.jobs > 1 else None
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(socket_path)
+                except OSError:  # left behind by a server that did not exit cleanly
+                    os.unlink(socket_path)
+                else:
+                    raise OSError(f'a server is already listening on {socket_path}')
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path, _analyzer_request_handler())
+        self.server.daemon_threads = True
+        self.server.analyzer = self
+
+    def run(self, request):
+        if self.executor is None:
+            return serve_request(request)
+        try:
+            return self.executor.submit(serve_request, request).result()
+        except RecursionError as e:  # a parse tree too deep to be sent back from the worker
+            return _error_response(request.get('id') if isinstance(request, dict) else None, e)
+
+    def serve_forever(self):
+        logging.info(f'Serving on {self.socket_path}')
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        return 0
+
+    def close(self):
+        self.server.server_close()
+        _remove_quietly(self.socket_path)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _analyzer_request_handler():
+    """request handler class of AnalyzerServer, defined once the server starts as socketserver is imported then"""
+    import socketserver
+
+    class _AnalyzerRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except (ValueError, RecursionError) as e:
+                    response = _error_response(None, e)
+                else:
+                    response = self.server.analyzer.run(request)
+                try:
+                    encoded = json.dumps(response)
+                except RecursionError as e:  # nested deeper than json can encode
+                    encoded = json.dumps(_error_response(response['id'], e))
+                self.wfile.write(encoded.encode() + b'\n')
+                self.wfile.flush()
+
+    return _AnalyzerRequestHandler
+
+
+class AnalyzerClient:
+    """client of an AnalyzerServer, that runs the requests in process if no server is listening"""
+
+    def __init__(self, socket_path, timeout=None):
+        """
+        Args:
+            socket_path (str): path of the server's unix domain socket
+            timeout (float): seconds to wait for a response, None to wait forever
+        """
+        import socket
+        self.socket_path = socket_path
+        self._ids = count()
+        try:
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.settimeout(timeout)
+            self._socket.connect(socket_path)
+        except (OSError, AttributeError):  # no server, or no unix sockets on this platform
+            self._socket = None
+            logging.info(f'No analyzer server on {socket_path}, analyzing in process')
+        else:
+            self._file = self._socket.makefile('rwb')
 
+    @property
+    def connected(self):
+        return self._socket is not None
 
-def handle_dir(path):
-    for f in os.listdir(path):
-        if f.endswith(IN_FILE_EXT):
-            handle_file(os.path.join(path, f))
+    def call(self, method, **params):
+        """run method of SERVER_METHODS with params
+        Returns:
+            list | str | dict: as returned by analyze_source
+        Raises:
+            ParseException: if the source is not valid jack
+            OSError: if the request failed otherwise
+        """
+        request = {'id': next(self._ids), 'method': method, 'params': params}
+        if self._socket is None:
+            response = serve_request(request)
+        else:
+            self._file.write(json.dumps(request).encode() + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+            if not line:
+                raise OSError(f'analyzer server on {self.socket_path} closed the connection')
+            response = json.loads(line)
+        error = response.get('error')
+        if error is not None:
+            if error['type'] in ('ParseException', 'ParseErrors'):
+                raise ParseException(error['message'])
+            raise OSError(f'{error["type"]}: {error["message"]}')
+        return response['result']
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def compile_files_with_client(paths, client, options=CompileOptions()):
+    """compile the given jack files into their xml files through an AnalyzerClient
+    Args:
+        options (CompileOptions): only where and how compressed the outputs are written is taken from it
+    Returns:
+        list: FileResult for every path
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                xml = client.call('parse_xml', source=f.read())
+            out_file_path = _out_file_path(path, options._replace(binary=False, tokens=None))
+            with atomic_open(out_file_path, compress=options.compress) as out_stream:
+                out_stream.write(xml)
+            result = FileResult(path)
+        except (ParseException, OSError, UnicodeDecodeError) as e:
+            result = FileResult(path, str(e))
+        _log_result(result)
+        results.append(result)
+    return results
+
+
+def compile_stdio(options=CompileOptions()):
+    """compile the jack class read from stdin to stdout, output is written as it is produced so an error leaves
+    it incomplete
+    Returns:
+        int: 0 if it compiled, 1 otherwise
+    """
+    diagnostics = [] if options.recover else None
+    if options.compress:
+        sys.stdout.flush()
+        out_stream = compressing_stream(sys.stdout.buffer, options.compress, options.binary)
+    else:
+        out_stream = sys.stdout.buffer if options.binary else sys.stdout
+    try:
+        symbols = _compile_stream(sys.stdin, out_stream, options, diagnostics)
+    except ParseErrors as e:
+        _log_result(FileResult('<stdin>', str(e), diagnostics=tuple(e.diagnostics)))
+        return 1
+    except (ParseException, UnicodeDecodeError) as e:
+        _log_result(FileResult('<stdin>', str(e)))
+        return 1
+    if options.compress:
+        out_stream.close()
+    else:
+        out_stream.flush()
+    if options.check:
+        [result] = check_calls([FileResult('<stdin>', symbols=symbols)])
+        if result.error is not None:
+            _log_result(result)
+            return 1
+    return 0
+
+
+def convert_binary_files(paths):
+    """write the parse tree of every BINARY_OUT_FILE_EXT file of paths to the OUT_FILE_EXT file next to it
+    Returns:
+        int: 0 if all were converted, 1 otherwise
+    """
+    status = 0
+    for path in paths:
+        if not path.endswith(BINARY_OUT_FILE_EXT):
+            logging.error(f'{path} is not a {BINARY_OUT_FILE_EXT} file')
+            status = 1
+            continue
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer, \
+                    atomic_open(_replace_ext(path, BINARY_OUT_FILE_EXT, OUT_FILE_EXT)) as out_stream:
+                binary_to_xml(buffer, out_stream)
+        except (OSError, ValueError, IndexError) as e:  # IndexError if the file is truncated
+            logging.error(f'Failed {path}: {e}')
+            status = 1
+        else:
+            logging.info(f'Converted {path}')
+    return status
+
+
+def _run_async(coroutine_function, **kwargs):
+    import asyncio
+    return lambda *args: asyncio.run(coroutine_function(*args, **kwargs))
+
+
+def _int_at_least(minimum):
+    """argparse type of the integers not below minimum, so that a value out of range is a usage error"""
+    def parse(text):
+        value = int(text)
+        if value < minimum:
+            raise argparse.ArgumentTypeError(f'{value} is less than {minimum}')
+        return value
+    parse.__name__ = 'int'  # named in argparse's message for text that is no integer
+    return parse
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='SyntaxAnalyzer.py', description='Parse jack source files into xml parse trees')
+    parser.add_argument('paths', nargs='*',
+                        help='jack source files or directories of jack source files, - to read one source from '
+                             'stdin and write its output to stdout')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='also compile the sources in the subdirectories of directories')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='only compile the sources of directories whose name or relative path matches GLOB, '
+                             'may be repeated')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='skip the sources and subdirectories of directories whose name or relative path '
+                             'matches GLOB, may be repeated')
+    parser.add_argument('-o', '--out-dir', metavar='DIR',
+                        help='write outputs under DIR, at the same place as their sources under the given '
+                             'directories (default: next to the sources)')
+    parser.add_argument('-j', '--jobs', type=_int_at_least(0), default=1,
+                        help='number of worker processes, 0 for one per cpu (default: 1)')
+    parser.add_argument('--token-buffer', action='store_true',
+                        help='tokenize each file whole into compact arrays before parsing it')
+    parser.add_argument('--binary', action='store_true',
+                        help=f'write a compact binary token stream and parse tree to {BINARY_OUT_FILE_EXT} files '
+                             f'instead of xml')
+    parser.add_argument('--to-xml', action='store_true',
+                        help=f'convert the given {BINARY_OUT_FILE_EXT} files to {OUT_FILE_EXT} files and exit')
+    parser.add_argument('--tokens', choices=TOKEN_OUT_FILE_EXTS, metavar='{xml,jsonl}',
+                        help='only tokenize, writing the nand2tetris <tokens> xml to T_test.xml files or json lines '
+                             'of [type, value, line, column] to T_test.jsonl files')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help='compress the outputs as they are written, adding the extension of the compression')
+    parser.add_argument('--flush-lines', type=int, default=EMITTER_FLUSH_LINES, metavar='N',
+                        help='xml lines held in memory before they are written out, with the default engine the '
+                             f'output of a class then takes constant memory (default: {EMITTER_FLUSH_LINES})')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        help='recover from syntax errors to report all of them, files with errors get no output')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and compile sources again whenever their content changes')
+    parser.add_argument('--watch-interval', type=float, default=WATCH_INTERVAL_SECONDS, metavar='SECONDS',
+                        help=f'seconds between polls in watch mode (default: {WATCH_INTERVAL_SECONDS})')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='run an analyzer server on the unix domain socket SOCKET, with --jobs worker processes')
+    parser.add_argument('--connect', metavar='SOCKET',
+                        help='compile through the analyzer server on SOCKET, in process if it is not running, '
+                             'into xml only and without the build cache')
+    parser.add_argument('--async', dest='pipeline', action='store_true',
+                        help='overlap reading, parsing and writing files in an asyncio pipeline')
+    parser.add_argument('--queue-depth', type=_int_at_least(1), default=ASYNC_QUEUE_DEPTH, metavar='N',
+                        help=f'files held between the stages of the --async pipeline (default: {ASYNC_QUEUE_DEPTH})')
+    parser.add_argument('--check', action='store_true',
+                        help='also report undeclared variables, and calls of undeclared subroutines or with the wrong '
+                             'number of arguments among the classes of the sources, files still get their output')
+    parser.add_argument('--index', metavar='PATH',
+                        help='write the classes, subroutines, variables and call sites of the sources to PATH')
+    parser.add_argument('--stats', action='store_true', help='print where the time went, per phase and production')
+    parser.add_argument('--stats-json', metavar='PATH', help='write per file timings and counts as json to PATH')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write cProfile stats of the run to PATH, worker processes are not profiled')
+    parser.add_argument('--no-cache', action='store_true', help='always recompile, neither read nor fill the cache')
+    parser.add_argument('--clear-cache', action='store_true', help='empty the build cache before compiling')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'build cache location (default: {CACHE_DIR})')
+    return parser.parse_args(args)
+
+
+# argparse dests of the options a mode of main cannot honour, by the dest of the mode's own option
+UNSUPPORTED_OPTIONS = {
+    'connect': ('binary', 'tokens', 'keep_going', 'check', 'index', 'watch', 'pipeline', 'stats', 'stats_json',
+                'profile'),
+    'pipeline': ('stats', 'stats_json'),  # its stages overlap, so there is no time of each file to report
+}
+FLAGS = {'pipeline': '--async'}  # of the dests not named after their flag
+
+
+def _unsupported_options(options, mode):
+    """log an error naming the options given with mode that it cannot honour
+    Returns:
+        bool: whether any was given
+    """
+    given = [_flag(dest) for dest in UNSUPPORTED_OPTIONS[mode] if getattr(options, dest)]
+    if given:
+        logging.error(f'{", ".join(given)} cannot be used with {_flag(mode)}')
+    return bool(given)
+
+
+def _flag(dest):
+    return FLAGS.get(dest) or f'--{dest.replace("_", "-")}'
 
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
-        if not args:
-            logging.error('Usage: SyntaxAnalyzer.py <path-to-jack-file-or-directory-of-source-code>')
-
-    for file in args:
-        if os.path.isfile(file):
-            handle_file(file)
-        elif os.path.isdir(file):
-            handle_dir(file)
-        else:
-            logging.error(f'{", ".join(args)} are not jack source files')
+    options = _parse_args(args)
+    if options.serve:
+        try:
+            server = AnalyzerServer(options.serve, options.jobs)
+        except OSError as e:
+            logging.error(f'Cannot serve on {options.serve}: {e}')
             return 1
-    return 0
+        return server.serve_forever()
+    cache = None if options.no_cache else BuildCache(options.cache_dir)
+    if options.clear_cache:
+        BuildCache(options.cache_dir).clear()
+        if not options.paths:
+            return 0
+    if not options.paths:
+        logging.error('Usage: SyntaxAnalyzer.py [--jobs N] <path-to-jack-file-or-directory-of-source-code>')
+        return 1
+    if options.to_xml:
+        return convert_binary_files(options.paths)
+    if any(getattr(options, mode) and _unsupported_options(options, mode) for mode in UNSUPPORTED_OPTIONS):
+        return 1
+
+    compile_options = CompileOptions(cache, options.token_buffer,
+                                     stats=bool(options.stats or options.stats_json), recover=options.keep_going,
+                                     index=bool(options.index), binary=options.binary, tokens=options.tokens,
+                                     out_dir=options.out_dir, check=options.check, flush_lines=options.flush_lines,
+                                     compress=options.compress,
+                                     source_roots=tuple(path if os.path.isdir(path) else os.path.dirname(path)
+                                                        for path in options.paths))
+    if options.paths == ['-']:
+        return compile_stdio(compile_options)
+
+    if not all(map(os.path.exists, options.paths)):
+        logging.error(f'{", ".join(options.paths)} are not jack source files')
+        return 1
+    discover = functools.partial(discover_sources, recursive=options.recursive, include=options.include,
+                                 exclude=options.exclude)
+    paths = discover(options.paths)  # compiled as they are found
+    if options.connect:
+        with AnalyzerClient(options.connect) as client:
+            results = compile_files_with_client(paths, client, compile_options)
+        return 0 if all(result.error is None for result in results) else 1
+    if options.watch:
+        return Watcher(options.paths, options.jobs, compile_options, options.watch_interval,
+                       discover=discover, index_path=options.index).run()
+    if options.pipeline:
+        compile_function = _run_async(compile_files_async, queue_depth=options.queue_depth)
+    else:
+        compile_function = compile_files
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        results = profiler.runcall(compile_function, paths, options.jobs, compile_options)
+        profiler.dump_stats(options.profile)
+    else:
+        results = compile_function(paths, options.jobs, compile_options)
+    if compile_options.stats:
+        summary = stats_summary(results)
+        if options.stats:
+            print_stats(summary)
+        if options.stats_json:
+            with open(options.stats_json, 'w') as f:
+                json.dump(summary, f, indent=1)
+    if options.index:
+        SymbolIndex.from_results(results).save(options.index)
+    return 0 if all(result.error is None for result in results) else 1
 
 
 if __name__ == '__main__':
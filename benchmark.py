@@ -0,0 +1,282 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import SyntaxAnalyzer
+
+# Generates synthetic jack classes of controllable size and shape and times the tokenizer, the compilation
+# engine and end to end handle_dir separately, e.g.
+#   python benchmark.py --shape nested --files 20 --size 300 --output bench.json
+# the parse_* phases compare the engines on the same tokens, the streaming CompilationEngine reading them from
+# lists and the ENGINES from token buffers
+
+NEWLINE = SyntaxAnalyzer.NEWLINE
+STREAMING = 'streaming'  # phase name of the CompilationEngine, the ENGINES are named by their key
+ENGINES = {'buffered': SyntaxAnalyzer.BufferedCompilationEngine}  # engines parsing token buffers
+SHAPES = ('mixed', 'nested', 'expressions', 'subroutines')
+OPS = ('+', '-', '*', '/', '&', '|', '<', '>', '=')
+OS_CALLS = ('Math.max', 'Math.min', 'Math.multiply')
+
+
+class JackGenerator:
+    """random but syntactically valid jack classes, the same for the same seed"""
+
+    def __init__(self, shape='mixed', size=200, depth=12, length=40, seed=0):
+        """
+        Args:
+            shape (str): one of SHAPES, what the generated code is made mostly of
+            size (int): number of statements per class, roughly
+            depth (int): nesting of if/while blocks for the nested shape, and of parentheses in expressions
+            length (int): number of terms in expressions for the expressions shape
+            seed (int): seed of the random generator
+        """
+        self.shape = shape
+        self.size = size
+        self.depth = depth
+        self.length = length
+        self.random = random.Random(seed)
+
+    def generate_class(self, name):
+        lines = [f'/** generated {self.shape} class */', f'class {name} {{',
+                 '    field int f0, f1;', '    static boolean s0;']
+        subroutines = max(1, self.size // 5) if self.shape == 'subroutines' else max(1, self.size // 50)
+        statements = max(1, self.size // subroutines)
+        for i in range(subroutines):
+            lines.append(f'    method int m{i}(int a, int b) {{')
+            lines.append('        var int x, y;')
+            lines.append('        var Array arr;  // locals')
+            budget = [statements]
+            while budget[0] > 0:
+                self._statement(lines, 2, budget)
+            lines.append('        return x;')
+            lines.append('    }')
+        lines.append('}')
+        return NEWLINE.join(lines) + NEWLINE
+
+    def _statement(self, lines, indent, budget):
+        budget[0] -= 1
+        pad = '    ' * indent
+        if self.shape == 'nested':
+            self._nested_block(lines, indent, budget)
+            return
+        kind = self.random.choice(('let', 'let', 'do', 'if', 'while', 'array') if self.shape == 'mixed' else ('let',))
+        if kind == 'let':
+            lines.append(f'{pad}let x = {self._expression(self.length if self.shape == "expressions" else 4)};')
+        elif kind == 'array':
+            lines.append(f'{pad}let arr[{self._expression(2)}] = {self._expression(3)};')
+        elif kind == 'do':
+            lines.append(f'{pad}do {self.random.choice(OS_CALLS)}({self._expression(3)}, {self._expression(2)});')
+        else:
+            lines.append(f'{pad}{kind} ({self._expression(3)}) {{')
+            lines.append(f'{pad}    let y = {self._expression(3)};')
+            lines.append(f'{pad}}}')
+
+    def _nested_block(self, lines, indent, budget):
+        # opened and closed iteratively so the generator itself does not recurse self.depth deep
+        closes = []
+        for level in range(self.depth):
+            pad = '    ' * (indent + level)
+            keyword = 'if' if level % 2 else 'while'
+            lines.append(f'{pad}{keyword} ({self._expression(2)}) {{')
+            lines.append(f'{pad}    let x = {self._expression(3)};')
+            closes.append(f'{pad}}}' + (' else { let y = 1; }' if keyword == 'if' else ''))
+            budget[0] -= 1
+        lines.extend(reversed(closes))
+
+    def _expression(self, terms):
+        parts = [self._term()]
+        for _ in range(terms - 1):
+            parts.append(self.random.choice(OPS))
+            parts.append(self._term())
+        return ' '.join(parts)
+
+    def _term(self):
+        kind = self.random.randrange(10)
+        if kind == 0:
+            return str(self.random.randrange(32768))
+        elif kind == 1:
+            return '"generated string"'
+        elif kind == 2:
+            return self.random.choice(('true', 'false', 'null', 'this'))
+        elif kind == 3:
+            return '-' + self.random.choice(('x', 'y', 'a'))
+        elif kind == 4:
+            # nested parentheses, iteratively for the same reason as _nested_block
+            nesting = self.random.randrange(1, self.depth + 1)
+            return '(' * nesting + 'x + 1' + ')' * nesting
+        elif kind == 5:
+            return f'm0({self.random.choice(("x", "a"))}, b)'
+        elif kind == 6:
+            return 'arr[y]'
+        return self.random.choice(('x', 'y', 'a', 'b', 'f0', 'f1'))
+
+
+def generate_corpus(directory, files, generator):
+    """write files generated jack classes into directory
+    Returns:
+        list: paths of the generated files
+    """
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f'Gen{i}.jack')
+        with open(path, 'w') as f:
+            f.write(generator.generate_class(f'Gen{i}'))
+        paths.append(path)
+    return paths
+
+
+def peak_allocated_kb(run):
+    """peak memory allocated by one more run of run, not counting what was allocated before it, traced apart
+    from the timed runs since tracing slows down every allocation. Worker processes are not traced
+    """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def _timed(run, repeat):
+    """best wall time of repeat runs, the value of the last run, and the peak_allocated_kb of run"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value, peak_allocated_kb(run)
+
+
+def _result(phase, seconds, tokens, size, peak_kb):
+    return {
+        'phase': phase,
+        'seconds': round(seconds, 6),
+        'tokens': tokens,
+        'bytes': size,
+        'tokens_per_sec': round(tokens / seconds) if seconds else None,
+        'mb_per_sec': round(size / seconds / 1e6, 3) if seconds else None,
+        'peak_kb': peak_kb,  # allocated by the phase alone
+    }
+
+
+def benchmark(directory, paths, repeat, jobs):
+    sources = []
+    for path in paths:
+        with open(path) as f:
+            sources.append(f.read())
+    size = sum(len(source.encode()) for source in sources)
+
+    def tokenize():
+        return sum(sum(1 for _ in SyntaxAnalyzer.JackTokenizer(source).start_tokenizer()) for source in sources)
+
+    seconds, tokens, peak_kb = _timed(tokenize, repeat)
+    results = [_result('tokenize', seconds, tokens, size, peak_kb)]
+
+    token_lists = [list(SyntaxAnalyzer.JackTokenizer(source).start_tokenizer()) for source in sources]
+
+    def parse_streaming():
+        with open(os.devnull, 'w') as out_stream:
+            for token_list in token_lists:
+                SyntaxAnalyzer.CompilationEngine(iter(token_list), out_stream).compile_class()
+
+    seconds, _, peak_kb = _timed(parse_streaming, repeat)
+    results.append(_result(f'parse_{STREAMING}', seconds, tokens, size, peak_kb))
+    del token_lists
+
+    token_buffers = [SyntaxAnalyzer.JackTokenizer(source).tokenize_to_buffer() for source in sources]
+    for engine_name, engine_class in ENGINES.items():
+        def parse():
+            with open(os.devnull, 'w') as out_stream:
+                for token_buffer in token_buffers:
+                    engine_class(token_buffer, out_stream).compile_class()
+
+        seconds, _, peak_kb = _timed(parse, repeat)
+        results.append(_result(f'parse_{engine_name}', seconds, tokens, size, peak_kb))
+    del token_buffers
+
+    seconds, file_results, peak_kb = _timed(lambda: SyntaxAnalyzer.handle_dir(directory, jobs), repeat)
+    for file_result in file_results:
+        if file_result.error is not None:
+            raise SystemExit(f'generated {file_result.path} does not parse: {file_result.error}')
+    results.append(_result('handle_dir', seconds, tokens, size, peak_kb))
+    return results, sources
+
+
+def _check_same_output(sources):
+    """the compared engines must write identical xml, or their timings mean nothing"""
+    engines = [(STREAMING, SyntaxAnalyzer.CompilationEngine), *ENGINES.items()]
+    for source in sources:
+        outputs = []
+        for name, engine_class in engines:
+            tokenizer = SyntaxAnalyzer.JackTokenizer(source)
+            tokens = tokenizer.start_tokenizer() if name == STREAMING else tokenizer.tokenize_to_buffer()
+            out_stream = io.StringIO()
+            engine_class(tokens, out_stream).compile_class()
+            outputs.append(out_stream.getvalue())
+        for (name, _), output in zip(engines[1:], outputs[1:]):
+            if output != outputs[0]:
+                raise SystemExit(f'{name} and {engines[0][0]} engines disagree on a generated source')
+
+
+def _print_table(results):
+    print(f'{"phase":<15} {"seconds":>9} {"tokens/s":>11} {"MB/s":>7} {"peak KB":>9}')
+    for r in results:
+        print(f'{r["phase"]:<15} {r["seconds"]:>9.3f} {r["tokens_per_sec"] or 0:>11,} '
+              f'{r["mb_per_sec"] or 0:>7.2f} {r["peak_kb"]:>9,}')
+
+
+def _print_engine_speedups(results, baseline=STREAMING):
+    """speedup of every engine over the baseline engine"""
+    seconds = {r['phase']: r['seconds'] for r in results}
+    for engine in ENGINES:
+        engine_seconds = seconds[f'parse_{engine}']
+        speedup = seconds[f'parse_{baseline}'] / engine_seconds if engine_seconds else float('nan')
+        print(f'{engine} vs {baseline}: {speedup:.2f}x')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Benchmark SyntaxAnalyzer on generated jack')
+    parser.add_argument('--shape', choices=SHAPES, default='mixed')
+    parser.add_argument('--files', type=int, default=20, help='number of generated classes (default: 20)')
+    parser.add_argument('--size', type=int, default=200, help='statements per class, roughly (default: 200)')
+    parser.add_argument('--depth', type=int, default=12, help='block and parenthesis nesting (default: 12)')
+    parser.add_argument('--length', type=int, default=40, help='terms per expression, expressions shape')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per phase, the best is kept (default: 3)')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for the handle_dir phase')
+    parser.add_argument('--output', help='append the results as a json line to this file')
+    options = parser.parse_args(args)
+    logging.disable(logging.INFO)  # handle_dir logs every file
+
+    generator = JackGenerator(options.shape, options.size, options.depth, options.length, options.seed)
+    with tempfile.TemporaryDirectory(prefix='jack-bench-') as directory:
+        paths = generate_corpus(directory, options.files, generator)
+        results, sources = benchmark(directory, paths, options.repeat, options.jobs)
+        _check_same_output(sources)
+
+    _print_table(results)
+    _print_engine_speedups(results)
+    if options.output:
+        run = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus': {key: getattr(options, key) for key in ('shape', 'files', 'size', 'depth', 'length', 'seed')},
+            'results': results,
+        }
+        with open(options.output, 'a') as f:
+            f.write(json.dumps(run) + NEWLINE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
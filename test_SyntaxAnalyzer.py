@@ -0,0 +1,620 @@
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import unittest
+
+import SyntaxAnalyzer
+import benchmark
+
+
+def doc_commented_class(methods, comment_lines=30):
+    """a class whose methods each have a multi-line /** */ doc comment"""
+    doc = '  /**\n' + ''.join(f'   * line {i}, with * stars and / slashes\n' for i in range(comment_lines)) + '   */\n'
+    return 'class Doc {\n' + ''.join(f'{doc}  method int m{i}(int a) {{ return a + {i}; }}\n'
+                                     for i in range(methods)) + '}\n'
+
+
+class CommentChunkBoundaryTest(unittest.TestCase):
+    """multi-line comments cut by the end of a chunk are tokenized without backtracking over their lines"""
+
+    def test_doc_comments_across_chunks(self):
+        source = doc_commented_class(20)
+        expected = list(SyntaxAnalyzer.JackTokenizer(source).start_tokenizer())
+        for chunk_size in (64, 256, 1000):
+            for in_stream in (io.StringIO(source), io.BytesIO(source.encode())):
+                tokens = list(SyntaxAnalyzer.JackTokenizer(in_stream, chunk_size).start_tokenizer())
+                self.assertEqual(tokens, expected)
+
+    def test_comment_longer_than_chunks(self):
+        source = 'class Big { /*' + 'x\n' * 5000 + '*/ }'
+        tokens = list(SyntaxAnalyzer.JackTokenizer(io.StringIO(source), 1024).start_tokenizer())
+        self.assertEqual([token.value for token in tokens], ['class', 'Big', '{', '}'])
+        self.assertEqual(tokens[-1].line_number, 5001)
+
+    def test_comment_of_megabytes_read_in_chunks(self):
+        # scanning the comment again with every chunk took minutes and held all of it in memory
+        source = 'class Big { /*' + 'a * line / of the comment\n' * 200000 + '*/ field int x; }'
+        with tempfile.TemporaryFile() as f:
+            f.write(source.encode())
+            f.seek(0)
+            tokens = list(SyntaxAnalyzer.JackTokenizer(f).start_tokenizer())
+        self.assertEqual(tokens, list(SyntaxAnalyzer.JackTokenizer(source).start_tokenizer()))
+        self.assertEqual(tokens[3], SyntaxAnalyzer.Token(SyntaxAnalyzer.KEYWORD, 'field', 200001, 4))
+
+    def test_unterminated_comment(self):
+        source = 'class A {\n  /* never closed\n}\n'
+        for in_stream in (source, io.StringIO(source)):
+            with self.assertRaisesRegex(SyntaxAnalyzer.ParseException, 'unterminated comment in line 2, column 3'):
+                list(SyntaxAnalyzer.JackTokenizer(in_stream, 4).start_tokenizer())
+        diagnostics = []
+        SyntaxAnalyzer.JackTokenizer(source, diagnostics=diagnostics).tokenize_to_buffer()
+        self.assertEqual(diagnostics, [SyntaxAnalyzer.Diagnostic(2, 'unterminated comment', 3)])
+
+    def test_incremental_edit_opening_comment(self):
+        source = 'class A {\n' + ''.join(f'  method void m{i}() {{ return; }}\n' for i in range(8)) + '}\n'
+        parser = SyntaxAnalyzer.IncrementalParser(source)
+        start = source.index('return')
+        with self.assertRaises(SyntaxAnalyzer.ParseException):
+            parser.edit(start, start, '/*')
+
+
+class TokenPositionTest(unittest.TestCase):
+    """tokens after multi-line block comments are at the line and column they are written at"""
+
+    SOURCE = ('class A { /* one\n'
+              '  two */ field int x; /** doc\n'
+              '   * é\n'
+              '   */\n'
+              '  method void f() { /* a */ return; }\n'
+              '/*\n'
+              '*/}')
+    # value, line number and column of every token
+    EXPECTED = [('class', 1, 1), ('A', 1, 7), ('{', 1, 9), ('field', 2, 10), ('int', 2, 16), ('x', 2, 20),
+                (';', 2, 21), ('method', 5, 3), ('void', 5, 10), ('f', 5, 15), ('(', 5, 16), (')', 5, 17),
+                ('{', 5, 19), ('return', 5, 29), (';', 5, 35), ('}', 5, 37), ('}', 7, 3)]
+
+    def assertPositions(self, tokens):
+        self.assertEqual([(token.value, token.line_number, token.column) for token in tokens], self.EXPECTED)
+
+    def test_str(self):
+        self.assertPositions(list(SyntaxAnalyzer.JackTokenizer(self.SOURCE).start_tokenizer()))
+
+    def test_chunks(self):
+        for chunk_size in range(1, len(self.SOURCE) + 1):
+            for name, in_stream in (('text', io.StringIO(self.SOURCE)), ('bytes', io.BytesIO(self.SOURCE.encode()))):
+                with self.subTest(input=f'{name} chunks of {chunk_size}'):
+                    self.assertPositions(list(SyntaxAnalyzer.JackTokenizer(in_stream, chunk_size).start_tokenizer()))
+
+    def test_token_buffer(self):
+        self.assertPositions(list(SyntaxAnalyzer.JackTokenizer(self.SOURCE).tokenize_to_buffer()))
+
+    def test_column_defaults_to_unknown(self):
+        self.assertEqual(SyntaxAnalyzer.Token(SyntaxAnalyzer.KEYWORD, 'class', 1).column, 0)
+
+
+class RecoveryTest(unittest.TestCase):
+    """both engines report each broken statement and carry on with the next one"""
+
+    SOURCE = 'class A { function void f() { var int x; let x = 1; foo; let x = ; return; } }'
+
+    def diagnostics(self, token_buffer):
+        diagnostics = []
+        options = SyntaxAnalyzer.CompileOptions(token_buffer=token_buffer)
+        with self.assertRaises(SyntaxAnalyzer.ParseErrors) as raised:
+            SyntaxAnalyzer._compile_stream(io.StringIO(self.SOURCE), io.StringIO(), options, diagnostics)
+        return raised.exception.diagnostics
+
+    def test_stray_token_in_statements(self):
+        for token_buffer in (False, True):
+            with self.subTest(token_buffer=token_buffer):
+                self.assertEqual(self.diagnostics(token_buffer), [
+                    SyntaxAnalyzer.Diagnostic(1, 'Got wrong token: foo, expected a statement', 53),
+                    SyntaxAnalyzer.Diagnostic(1, "Got wrong token: ;, expected: 'identifier'", 66),
+                ])
+
+
+class EngineOutputTest(unittest.TestCase):
+    """the streaming CompilationEngine and the BufferedCompilationEngine write identical xml"""
+
+    def test_same_xml(self):
+        for shape in benchmark.SHAPES:
+            source = benchmark.JackGenerator(shape, size=40, depth=6, length=12, seed=2).generate_class('Gen')
+            outputs = []
+            for token_buffer in (False, True):
+                out_stream = io.StringIO()
+                options = SyntaxAnalyzer.CompileOptions(token_buffer=token_buffer, flush_lines=7)
+                SyntaxAnalyzer._compile_stream(io.StringIO(source), out_stream, options)
+                outputs.append(out_stream.getvalue())
+            with self.subTest(shape=shape):
+                self.assertIn('<expression>', outputs[0])
+                self.assertEqual(outputs[1], outputs[0])
+
+
+def flatten(node):
+    """(kind, line number, value) of node and everything under it in document order, None as value for nodes"""
+    flat = []
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (SyntaxAnalyzer.Leaf, SyntaxAnalyzer.BinaryLeaf)):
+            flat.append((node.kind, node.line_number, node.value))
+        else:
+            flat.append((node.kind, node.line_number, None))
+            pending.extend(reversed(node.children))
+    return flat
+
+
+class BinaryFormatTest(unittest.TestCase):
+    """dump_binary keeps every token and the whole parse tree, and reading it back gives what was parsed"""
+
+    SOURCES = (benchmark.JackGenerator(size=30, seed=3).generate_class('Gen'),
+               'class S { function void f() { do Output.printString("a < b & \\ é"); return; } }\n')
+
+    def setUp(self):
+        self.source = self.SOURCES[0]
+        binary = io.BytesIO()
+        SyntaxAnalyzer._compile_stream(io.StringIO(self.source), binary, SyntaxAnalyzer.CompileOptions(binary=True))
+        self.binary = binary.getvalue()
+        xml = io.StringIO()
+        SyntaxAnalyzer.CompilationEngine(SyntaxAnalyzer.JackTokenizer(self.source).start_tokenizer(),
+                                         xml).compile_class()
+        self.xml = xml.getvalue()
+
+    def test_round_trip(self):
+        for source in self.SOURCES:
+            with self.subTest(source=source[:20]):
+                token_buffer = SyntaxAnalyzer.JackTokenizer(source).tokenize_to_buffer()
+                root = SyntaxAnalyzer.build_ast(token_buffer)
+                binary = io.BytesIO()
+                SyntaxAnalyzer.dump_binary(token_buffer, root, binary)
+                document = SyntaxAnalyzer.BinaryDocument(binary.getvalue())
+                self.assertEqual(list(document.tokens()), list(token_buffer))
+                self.assertEqual(flatten(document.root.to_node()), flatten(root))
+                self.assertEqual(flatten(document.root), flatten(root))
+
+    def test_same_xml_as_compilation_engine(self):
+        document = SyntaxAnalyzer.BinaryDocument(self.binary)
+        self.assertEqual(list(document.tokens()), list(SyntaxAnalyzer.JackTokenizer(self.source).start_tokenizer()))
+        from_binary = io.StringIO()
+        SyntaxAnalyzer.binary_to_xml(self.binary, from_binary)
+        self.assertEqual(from_binary.getvalue(), self.xml)
+        from_nodes = io.StringIO()
+        SyntaxAnalyzer.write_xml(document.root.to_node(), from_nodes)
+        self.assertEqual(from_nodes.getvalue(), self.xml)
+
+    def test_empty_source(self):
+        binary = io.BytesIO()
+        SyntaxAnalyzer.dump_binary([], None, binary)
+        document = SyntaxAnalyzer.BinaryDocument(binary.getvalue())
+        self.assertEqual(list(document.tokens()), [])
+        self.assertIsNone(document.root)
+
+    def test_truncated_buffer_raises_index_error(self):
+        # convert_binary_files reports an IndexError as a broken file instead of crashing
+        for end in range(len(SyntaxAnalyzer.BINARY_MAGIC), len(self.binary)):
+            with self.subTest(end=end):
+                with self.assertRaises(IndexError):
+                    SyntaxAnalyzer.binary_to_xml(self.binary[:end], io.StringIO())
+
+    def test_truncated_file_not_converted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f'Gen{SyntaxAnalyzer.BINARY_OUT_FILE_EXT}')
+            with open(path, 'wb') as f:
+                f.write(self.binary[:len(self.binary) // 2])
+            logging.disable(logging.ERROR)
+            self.addCleanup(logging.disable, logging.NOTSET)
+            self.assertEqual(SyntaxAnalyzer.convert_binary_files([path]), 1)
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+
+
+class IncrementalParserTest(unittest.TestCase):
+    """edits parsed again in place leave the parser with the tree, tokens and xml of a full parse"""
+
+    SOURCE = ('class A {\n'
+              '  field int x;\n'
+              '  method void f() {\n'
+              '    let x = 1;\n'
+              '    return;\n'
+              '  }\n'
+              '  method int g(int a) {\n'
+              '    var int b;\n'
+              '    let b = a + x;\n'
+              '    return b;\n'
+              '  }\n'
+              '  function void h() { do Output.printInt(2); return; }\n'
+              '}\n')
+
+    def assertSameAsFullParse(self, parser):
+        token_buffer = SyntaxAnalyzer.JackTokenizer(parser.source).tokenize_to_buffer()
+        xml = io.StringIO()
+        SyntaxAnalyzer.CompilationEngine(SyntaxAnalyzer.JackTokenizer(parser.source).start_tokenizer(),
+                                         xml).compile_class()
+        # tokens first, the tree then has no lines left to shift
+        self.assertEqual(list(parser.tokens()), list(token_buffer))
+        self.assertEqual(flatten(parser.tree), flatten(SyntaxAnalyzer.build_ast(token_buffer)))
+        written = io.StringIO()
+        parser.write_xml(written)
+        self.assertEqual(written.getvalue(), xml.getvalue())
+
+    def edit(self, parser, old, new, occurrence=0):
+        start = -1
+        for _ in range(occurrence + 1):
+            start = parser.source.index(old, start + 1)
+        return parser.edit(start, start + len(old), new)
+
+    def test_edit_inside_subroutine(self):
+        parser = SyntaxAnalyzer.IncrementalParser(self.SOURCE)
+        self.assertTrue(self.edit(parser, 'let b = a + x;', 'let b = (a * x) - Math.abs(a);'))
+        self.assertSameAsFullParse(parser)
+
+    def test_edit_adding_lines_before_later_subroutines(self):
+        parser = SyntaxAnalyzer.IncrementalParser(self.SOURCE)
+        self.assertTrue(self.edit(parser, 'let x = 1;', 'let x = 1;\n    let x = x + 1;\n\n    let x = -x;'))
+        self.assertTrue(self.edit(parser, 'var int b;', 'var int b, c;\n    var boolean d;'))
+        self.assertSameAsFullParse(parser)
+        h = parser.tree.children[-2]
+        self.assertEqual((h.kind, h.line_number), ('subroutineDec', 16))
+
+    def test_edit_removing_lines(self):
+        parser = SyntaxAnalyzer.IncrementalParser(self.SOURCE)
+        self.assertTrue(self.edit(parser, 'let x = 1;\n    return;', 'return;'))
+        self.assertSameAsFullParse(parser)
+        self.assertTrue(self.edit(parser, 'return;', 'let x = 2;\n    return;'))
+        self.assertSameAsFullParse(parser)
+
+    def test_edit_outside_subroutines_parses_everything(self):
+        parser = SyntaxAnalyzer.IncrementalParser(self.SOURCE)
+        self.assertFalse(self.edit(parser, 'field int x;', 'field int x, y;\n  static char z;'))
+        self.assertSameAsFullParse(parser)
+        self.assertTrue(self.edit(parser, 'return b;', 'return b + y;'))
+        self.assertSameAsFullParse(parser)
+
+    def test_random_edits(self):
+        parser = SyntaxAnalyzer.IncrementalParser(
+            benchmark.JackGenerator('subroutines', size=40, seed=1).generate_class('Gen'))
+        rng = random.Random(0)
+        reparsed = 0
+        for _ in range(150):
+            source = parser.source
+            start = rng.randrange(len(source))
+            end = min(len(source), start + rng.randrange(30))
+            text = rng.choice(('', 'let x = 1;\n', '\n\n', ' ', 'x', '}', '  method void q() { return; }\n'))
+            try:
+                reparsed += parser.edit(start, end, text)
+            except SyntaxAnalyzer.ParseException:
+                with self.assertRaises(SyntaxAnalyzer.ParseException):
+                    SyntaxAnalyzer.build_ast(SyntaxAnalyzer.JackTokenizer(parser.source).tokenize_to_buffer())
+                parser = SyntaxAnalyzer.IncrementalParser(source)
+                continue
+            with self.subTest(start=start, end=end, text=text):
+                self.assertSameAsFullParse(parser)
+        self.assertGreater(reparsed, 5)
+
+
+# fragments of token soups, including characters no token starts with, broken string constants and comments
+SOUP_FRAGMENTS = ('class', 'let', 'x1', '_y', '0', '32767', '"str"', '""', '"', '"open\n', '{', '}', '(', ')',
+                  ';', '.', '-', '*', '/', '//', '// line\n', '/* c */', '/** d\n * e */', '/*', '*/', '**',
+                  '#', '$', '\\', '?', ' ', '  ', '\t', '\n', '\n\n', 'é')
+
+
+def token_soup(rng, fragments):
+    return ''.join(rng.choice(SOUP_FRAGMENTS) for _ in range(fragments))
+
+
+class ChunkedInputTest(unittest.TestCase):
+    """sources read in chunks produce exactly the tokens and errors of the same source given as a str"""
+
+    CHUNK_SIZES = (1, 2, 3, 7)
+
+    def sources(self):
+        generator = benchmark.JackGenerator(size=30, seed=1)
+        yield from (generator.generate_class(f'Gen{i}') for i in range(2))
+        rng = random.Random(4)
+        yield from (token_soup(rng, 80) for _ in range(40))
+
+    @staticmethod
+    def tokenize(in_stream, **kwargs):
+        """tokens and diagnostics of in_stream, with the ParseException message if tokenizing stopped on one"""
+        diagnostics = kwargs.get('diagnostics')
+        tokens = []
+        try:
+            tokens.extend(SyntaxAnalyzer.JackTokenizer(in_stream, **kwargs).start_tokenizer())
+        except SyntaxAnalyzer.ParseException as e:
+            return tokens, diagnostics, str(e)
+        return tokens, diagnostics, None
+
+    def assertSameTokens(self, source, recovering):
+        expected = self.tokenize(source, diagnostics=[] if recovering else None)
+        for chunk_size in self.CHUNK_SIZES:
+            for name, in_stream in (('text', io.StringIO(source)), ('bytes', io.BytesIO(source.encode()))):
+                with self.subTest(source=source[:40], input=f'{name} chunks of {chunk_size}'):
+                    got = self.tokenize(in_stream, chunk_size=chunk_size, diagnostics=[] if recovering else None)
+                    self.assertEqual(got, expected)
+
+    def test_same_tokens_or_exception(self):
+        for source in self.sources():
+            self.assertSameTokens(source, recovering=False)
+
+    def test_same_tokens_and_diagnostics(self):
+        for source in self.sources():
+            self.assertSameTokens(source, recovering=True)
+
+    def test_token_buffer_of_same_tokens(self):
+        for source in self.sources():
+            with self.subTest(source=source[:40]):
+                tokens = list(SyntaxAnalyzer.JackTokenizer(source, diagnostics=[]).start_tokenizer())
+                token_buffer = SyntaxAnalyzer.JackTokenizer(source, diagnostics=[]).tokenize_to_buffer()
+                self.assertEqual(list(token_buffer), tokens)
+
+
+class ServeRequestTest(unittest.TestCase):
+
+    def test_parse_tree_deeper_than_recursion_limit(self):
+        source = 'class A { function int f() { return ' + '(' * 3000 + '1' + ')' * 3000 + '; } }'
+        response = SyntaxAnalyzer.serve_request({'id': 1, 'method': 'parse_ast', 'params': {'source': source}})
+        self.assertEqual(response['result']['kind'], 'class')
+
+    def test_paths_are_not_read(self):
+        response = SyntaxAnalyzer.serve_request({'id': 2, 'method': 'parse_xml', 'params': {'path': __file__}})
+        self.assertEqual(response['error']['type'], 'KeyError')
+
+
+class WriteTokensTest(unittest.TestCase):
+
+    def test_string_constants_without_quotes(self):
+        source = 'class A { function void f() { do Output.printString("a \\ é"); return; } }'
+        out_stream = io.StringIO()
+        SyntaxAnalyzer.write_tokens(SyntaxAnalyzer.JackTokenizer(source).start_tokenizer(), out_stream, 'jsonl')
+        lines = [json.loads(line) for line in out_stream.getvalue().splitlines()]
+        self.assertIn(['stringConstant', 'a \\ é', 1, 53], lines)
+
+
+class FilesTest(unittest.TestCase):
+    """works on jack files in a temporary directory, with the logging of every compiled file silenced"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def write(self, name, source):
+        """write source to the jack file name, a path relative to the directory without the extension
+        Returns:
+            str: path of the file
+        """
+        path = os.path.join(self.directory, f'{name}.jack')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(source)
+        return path
+
+    @staticmethod
+    def read(path):
+        with open(path) as f:
+            return f.read()
+
+
+class BuildCacheTest(FilesTest):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.cache = SyntaxAnalyzer.BuildCache(self.cache_dir)
+
+    def compile(self, path, **options):
+        [result] = SyntaxAnalyzer.compile_files([path], options=SyntaxAnalyzer.CompileOptions(self.cache, **options))
+        self.assertIsNone(result.error)
+        return result
+
+    def test_unchanged_source_restored(self):
+        path = self.write('A', 'class A { field int x; }')
+        out_path = os.path.join(self.directory, f'A{SyntaxAnalyzer.OUT_FILE_EXT}')
+        self.assertFalse(self.compile(path).cached)
+        xml = self.read(out_path)
+        os.remove(out_path)
+        self.assertTrue(self.compile(path).cached)
+        self.assertEqual(self.read(out_path), xml)
+        # another kind of output of the same source is not the cached xml
+        self.assertFalse(self.compile(path, binary=True).cached)
+        self.write('A', 'class A { field int y; }')
+        self.assertFalse(self.compile(path).cached)
+        self.assertNotEqual(self.read(out_path), xml)
+
+    def test_evict_expired_then_least_recently_used(self):
+        cache = SyntaxAnalyzer.BuildCache(self.cache_dir, max_bytes=100, max_age_seconds=1000)
+        out_path = os.path.join(self.directory, 'out.xml')
+        with open(out_path, 'w') as f:
+            f.write('x' * 40)
+        keys = [cache.content_key(bytes([i])) for i in range(4)]
+        now = time.time()
+        # used 2000, 30, 20 and 10 seconds ago, the first one is expired
+        for key, age in zip(keys, (2000, 30, 20, 10)):
+            cache.store(key, out_path)
+            os.utime(cache._entry_path(key), (now - age, now - age))
+        cache.evict()
+        # two entries of 40 bytes fit in 100
+        self.assertEqual([cache.restore(key, out_path) for key in keys], [False, False, True, True])
+
+    def test_clear_cache(self):
+        self.compile(self.write('A', 'class A { }'))
+        self.assertTrue(os.listdir(self.cache_dir))
+        self.assertEqual(SyntaxAnalyzer.main(['--clear-cache', '--cache-dir', self.cache_dir]), 0)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class AtomicOpenTest(FilesTest):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, 'A_test.xml')
+        with SyntaxAnalyzer.atomic_open(self.path) as f:
+            f.write('<class>\n')
+        os.utime(self.path, (0, 0))
+
+    def test_unchanged_output_not_replaced(self):
+        inode = os.stat(self.path).st_ino
+        with SyntaxAnalyzer.atomic_open(self.path) as f:
+            f.write('<class>\n')
+        self.assertEqual(os.stat(self.path).st_mtime, 0)
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.listdir(self.directory), ['A_test.xml'])
+
+    def test_changed_output_replaced(self):
+        with SyntaxAnalyzer.atomic_open(self.path) as f:
+            f.write('<class>\n</class>\n')
+        self.assertNotEqual(os.stat(self.path).st_mtime, 0)
+        self.assertEqual(self.read(self.path), '<class>\n</class>\n')
+        self.assertEqual(os.listdir(self.directory), ['A_test.xml'])
+
+    def test_failed_write_leaves_output(self):
+        with self.assertRaises(SyntaxAnalyzer.ParseException):
+            with SyntaxAnalyzer.atomic_open(self.path) as f:
+                f.write('<class>\n</class>\n')
+                raise SyntaxAnalyzer.ParseException('broken')
+        self.assertEqual(self.read(self.path), '<class>\n')
+        self.assertEqual(os.listdir(self.directory), ['A_test.xml'])
+
+
+class OutDirTest(FilesTest):
+
+    def setUp(self):
+        super().setUp()
+        self.sources = os.path.join(self.directory, 'src')
+        self.out_dir = os.path.join(self.directory, 'out')
+        for name in ('src/A', 'src/sub/B', 'src/sub/deeper/C', 'lib/D'):
+            self.write(name, f'class {os.path.basename(name)} {{ }}')
+
+    def outputs(self):
+        return sorted(os.path.relpath(os.path.join(directory, name), self.out_dir)
+                      for directory, _, names in os.walk(self.out_dir) for name in names)
+
+    def test_layout_of_directories_mirrored(self):
+        lib = os.path.join(self.directory, 'lib')
+        self.assertEqual(SyntaxAnalyzer.main([self.sources, lib, '-r', '-o', self.out_dir, '--no-cache']), 0)
+        self.assertEqual(self.outputs(), ['A_test.xml', 'D_test.xml', os.path.join('sub', 'B_test.xml'),
+                                          os.path.join('sub', 'deeper', 'C_test.xml')])
+        self.assertIn('<identifier> C </identifier>',
+                      self.read(os.path.join(self.out_dir, 'sub', 'deeper', 'C_test.xml')))
+        # nothing is written next to the sources
+        self.assertEqual(sorted(os.listdir(os.path.join(self.sources, 'sub'))), ['B.jack', 'deeper'])
+
+    def test_files_written_directly_in_out_dir(self):
+        path = os.path.join(self.sources, 'sub', 'deeper', 'C.jack')
+        self.assertEqual(SyntaxAnalyzer.main([path, '-o', self.out_dir, '--no-cache']), 0)
+        self.assertEqual(self.outputs(), ['C_test.xml'])
+
+
+class DiscoverSourcesTest(FilesTest):
+
+    def setUp(self):
+        super().setUp()
+        for name in ('Main', 'lib/Math', 'lib/Test', 'lib/deep/Screen', 'test/TestMain'):
+            self.write(name, '')
+        with open(os.path.join(self.directory, 'notes.txt'), 'w'):
+            pass
+
+    def discover(self, paths=None, **kwargs):
+        """paths found, relative to the directory"""
+        paths = [self.directory] if paths is None else [os.path.join(self.directory, path) for path in paths]
+        return [os.path.relpath(path, self.directory).replace(os.sep, '/')
+                for path in SyntaxAnalyzer.discover_sources(paths, **kwargs)]
+
+    def test_files_before_subdirectories_in_name_order(self):
+        self.assertEqual(self.discover(), ['Main.jack'])
+        self.assertEqual(self.discover(recursive=True), ['Main.jack', 'lib/Math.jack', 'lib/Test.jack',
+                                                         'lib/deep/Screen.jack', 'test/TestMain.jack'])
+
+    def test_given_files_always_yielded(self):
+        self.assertEqual(self.discover(['notes.txt', 'lib'], exclude=['*.txt']), ['notes.txt', 'lib/Math.jack',
+                                                                                   'lib/Test.jack'])
+
+    def test_include(self):
+        self.assertEqual(self.discover(recursive=True, include=['Test*']), ['lib/Test.jack', 'test/TestMain.jack'])
+        # * of fnmatch also matches /
+        self.assertEqual(self.discover(recursive=True, include=['lib/*']),
+                         ['lib/Math.jack', 'lib/Test.jack', 'lib/deep/Screen.jack'])
+        self.assertEqual(self.discover(recursive=True, include=['Main.jack', '*/deep/*']),
+                         ['Main.jack', 'lib/deep/Screen.jack'])
+
+    def test_exclude(self):
+        self.assertEqual(self.discover(recursive=True, exclude=['test', 'deep']),
+                         ['Main.jack', 'lib/Math.jack', 'lib/Test.jack'])
+        self.assertEqual(self.discover(recursive=True, exclude=['lib/Test.jack', 'Test*']),
+                         ['Main.jack', 'lib/Math.jack', 'lib/deep/Screen.jack'])
+        self.assertEqual(self.discover(recursive=True, include=['*Main*'], exclude=['test']), ['Main.jack'])
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symbolic links')
+    def test_symlink_loops_walked_once(self):
+        try:
+            os.symlink(self.directory, os.path.join(self.directory, 'lib', 'deep', 'loop'))
+            os.symlink(os.path.join(self.directory, 'lib'), os.path.join(self.directory, 'test', 'lib'))
+        except OSError as e:
+            self.skipTest(f'cannot create symbolic links: {e}')
+        self.assertEqual(self.discover(recursive=True), ['Main.jack', 'lib/Math.jack', 'lib/Test.jack',
+                                                         'lib/deep/Screen.jack', 'test/TestMain.jack'])
+        self.assertEqual(self.discover(['test'], recursive=True), ['test/TestMain.jack', 'test/lib/Math.jack',
+                                                                   'test/lib/Test.jack', 'test/lib/deep/Screen.jack',
+                                                                   'test/lib/deep/loop/Main.jack'])
+
+
+class CountingCache(SyntaxAnalyzer.BuildCache):
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.evictions = 0
+
+    def evict(self):
+        self.evictions += 1
+        super().evict()
+
+
+class WatcherTest(FilesTest):
+
+    def test_index_written_after_every_build(self):
+        self.write('A', 'class A { function void f() { do B.g(); return; } }')
+        self.write('B', 'class B { function void g() { return; } }')
+        index_path = os.path.join(self.directory, 'index.json')
+        watcher = SyntaxAnalyzer.Watcher([self.directory], options=SyntaxAnalyzer.CompileOptions(index=True),
+                                         interval=0, debounce=0, index_path=index_path)
+        watcher.run(rounds=1)
+        self.assertEqual(sorted(SyntaxAnalyzer.SymbolIndex.load(index_path).classes), ['A', 'B'])
+        os.remove(os.path.join(self.directory, 'B.jack'))
+        self.write('C', 'class C { }')
+        watcher.run(rounds=1)
+        index = SyntaxAnalyzer.SymbolIndex.load(index_path)
+        self.assertEqual(sorted(index.classes), ['A', 'C'])
+        self.assertEqual(len(index.calls_to('B', 'g')), 1)
+
+    def test_pool_and_cache_eviction_shared_by_builds(self):
+        cache = CountingCache(os.path.join(self.directory, 'cache'))
+        watcher = SyntaxAnalyzer.Watcher([self.directory], jobs=2, options=SyntaxAnalyzer.CompileOptions(cache))
+        self.addCleanup(watcher.close)
+        self.write('A', 'class A { }')
+        self.write('B', 'class B { }')
+        watcher.build(watcher.poll())
+        executor = watcher._executor
+        self.write('A', 'class A { field int x; }')
+        self.write('B', 'class B { field int y; }')
+        results = watcher.build(watcher.poll())
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertIs(watcher._executor, executor)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_changed_classes_checked_against_unchanged_ones(self):
+        self.write('A', 'class A { function void f() { do B.g(1); return; } }')
+        self.write('B', 'class B { function void g(int x) { return; } }')
+        watcher = SyntaxAnalyzer.Watcher([self.directory], options=SyntaxAnalyzer.CompileOptions(check=True))
+        self.assertTrue(all(result.error is None for result in watcher.build(watcher.poll())))
+        self.write('A', 'class A { function void f() { do B.g(1, 2); do B.h(); return; } }')
+        [result] = watcher.build(watcher.poll())
+        self.assertEqual(len(result.diagnostics), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()